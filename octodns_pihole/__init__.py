@@ -2,16 +2,39 @@
 #
 #
 
+import atexit
 import logging
-from collections import defaultdict
+import re
+import sys
+from array import array
+from codecs import getincrementaldecoder
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from hashlib import sha256
+from importlib import import_module
 from ipaddress import ip_address
-
-from requests import Session
+from json import dump, dumps, load
+from json.decoder import scanstring
+from os import _exit, makedirs, replace, unlink
+from os.path import join
+from socket import AF_INET, AF_INET6, inet_ntop, inet_pton
+from sys import intern
+from threading import Lock
+from time import monotonic, perf_counter, time
+from urllib.parse import quote
+from weakref import WeakSet, finalize
+from zlib import compressobj
+
+from requests import HTTPError, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from octodns import __VERSION__ as octodns_version
+from octodns.idna import IdnaError, idna_encode
 from octodns.provider import ProviderException
 from octodns.provider.base import BaseProvider
-from octodns.record import Record
+from octodns.record import Record, Update
 
 # TODO: remove __VERSION__ with the next major version release
 __version__ = __VERSION__ = '0.0.1'
@@ -31,11 +54,665 @@ class PiholeClientUnauthorized(PiholeClientException):
         super().__init__('Unauthorized')
 
 
+class PiholeClientConflict(PiholeClientException):
+    pass
+
+
+class PiholeFleetException(PiholeClientException):
+    def __init__(self, results):
+        failed = ', '.join(f'{r.url} ({r.error})' for r in results if r.error)
+        super().__init__(f'Failed to update {failed}')
+        self.results = results
+
+
+def fingerprint(entries):
+    """Order insensitive digest of a Pi-hole list"""
+    return sha256('\n'.join(sorted(entries)).encode()).hexdigest()
+
+
+def content_hash(hosts, cnames):
+    """Digest of a snapshot's lists, order sensitive"""
+    return sha256(dumps([hosts, cnames]).encode()).hexdigest()
+
+
+_JSON_SKIP = re.compile(r'[\s,:]*')
+_JSON_SCALAR = re.compile(r'[^\s,:\]}]+')
+
+
+def iter_json_lists(chunks, paths):
+    """Yields (path, item) for the string items of the JSON arrays at paths
+
+    The document is parsed incrementally from chunks of bytes so that only
+    the current chunk and item are held, never the whole document. paths
+    are tuples of object keys, e.g. ('config', 'dns', 'hosts'), everything
+    else is skipped over without being decoded. Raises ValueError if the
+    document is malformed, truncated or missing any of paths.
+    """
+    chunks = iter(chunks)
+    decoder = getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    final = False
+    missing = set(paths)
+    # Open containers as [path, is an object, key awaiting its value]
+    stack = []
+
+    while True:
+        pos = _JSON_SKIP.match(buf, pos).end()
+        if pos < len(buf):
+            c = buf[pos]
+            parent = stack[-1] if stack else None
+            match parent:
+                case None:
+                    path = ()
+                case [container, True, key]:
+                    path = container + (key,)
+                case _:
+                    # items of an array share its path
+                    path = parent[0]
+
+            incomplete = False
+            if c in '{[':
+                stack.append([path, c == '{', None])
+                missing.discard(path)
+                pos += 1
+                continue
+            elif c in '}]':
+                if not stack:
+                    raise ValueError('Malformed JSON document')
+                stack.pop()
+                pos += 1
+            elif c == '"':
+                try:
+                    value, end = scanstring(buf, pos + 1)
+                except ValueError:
+                    incomplete = True
+                else:
+                    pos = end
+                    if parent and parent[1] and parent[2] is None:
+                        # an object's key, its value comes next
+                        parent[2] = value
+                        continue
+                    if parent and not parent[1] and path in paths:
+                        yield path, value
+            else:
+                end = _JSON_SCALAR.match(buf, pos).end()
+                if end == len(buf) and not final:
+                    incomplete = True
+                else:
+                    pos = end
+
+            if not incomplete:
+                # the value is done with, its object moves on to the next key
+                if stack and stack[-1][1]:
+                    stack[-1][2] = None
+                continue
+        elif final:
+            break
+
+        # Need more of the document to make progress
+        if final:
+            raise ValueError('Truncated JSON document')
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+            chunk = b''
+        buf = buf[pos:] + decoder.decode(chunk, final)
+        pos = 0
+
+    if stack:
+        raise ValueError('Truncated JSON document')
+    if missing:
+        raise ValueError(f'JSON document is missing {sorted(missing)}')
+
+
+class PatchBody(object):
+    """The {"config": {"dns": dns}} body of a PATCH, encoded as it is sent
+
+    Iterating yields it in chunks of about chunk_size bytes. Its length is
+    worked out from the entries' encoded lengths, so it can be sent with a
+    Content-Length without ever being held whole.
+    """
+
+    def __init__(self, dns, chunk_size=64 * 1024):
+        self.dns = dns
+        self.chunk_size = chunk_size
+        self._length = None
+
+    def _parts(self):
+        # dumps escapes everything outside of ASCII, one char is one byte
+        yield '{"config": {"dns": {'
+        for i, (key, entries) in enumerate(self.dns.items()):
+            yield f'{", " if i else ""}{dumps(key)}: ['
+            for j, entry in enumerate(entries):
+                yield f'{", " if j else ""}{dumps(entry)}'
+            yield ']'
+        yield '}}}'
+
+    def __iter__(self):
+        parts = []
+        size = 0
+        for part in self._parts():
+            parts.append(part)
+            size += len(part)
+            if size >= self.chunk_size:
+                yield ''.join(parts).encode()
+                parts = []
+                size = 0
+        yield ''.join(parts).encode()
+
+    def __len__(self):
+        if self._length is None:
+            self._length = sum(len(part) for part in self._parts())
+        return self._length
+
+    def compressed(self):
+        """Returns the body gzip compressed"""
+        compressor = compressobj(wbits=31)
+        return b''.join(compressor.compress(c) for c in self) + (
+            compressor.flush()
+        )
+
+
+def merge_lists(remote, added, removed):
+    """Three-way merge of a Pi-hole list
+
+    Applies the entries added and removed from a base to remote, the list
+    as it is now, keeping remote's order and whatever else changed in it.
+    """
+    removed = set(removed)
+    merged = [e for e in remote if e not in removed]
+    present = set(merged)
+    merged.extend(e for e in added if e not in present)
+    return merged
+
+
+def merge_conflicts(hosts, cnames, added_hosts, added_cnames):
+    """Returns the names our additions conflict on in a merged snapshot
+
+    A CNAME can't share its name with another CNAME or any hosts entry,
+    which is what concurrent edits of the same name end up doing.
+    """
+    targets = defaultdict(set)
+    for entry in cnames:
+        name, target = entry.split(',', 1)
+        targets[name].add(target)
+    addressed = {entry.split(' ', 1)[1] for entry in hosts}
+
+    conflicts = set()
+    for entry in added_cnames:
+        name, _ = entry.split(',', 1)
+        if len(targets[name]) > 1 or name in addressed:
+            conflicts.add(name)
+    for entry in added_hosts:
+        name = entry.split(' ', 1)[1]
+        if name in targets:
+            conflicts.add(name)
+    return sorted(conflicts)
+
+
+class RecordStore(object):
+    """Insertion ordered set of Pi-hole list entries
+
+    Pi-hole keeps local hosts and CNAMEs as plain lists of strings. This
+    keeps them in a list indexed by value so that add, discard, replace and
+    membership checks are O(1) while iteration still yields the entries in
+    their original order, new entries appended at the end and replacements
+    in the place of what they replaced.
+    """
+
+    def __init__(self, entries=()):
+        # discarded entries leave None behind until compacted
+        self._entries = []
+        # entry: its index in _entries
+        self._positions = {}
+        for entry in entries:
+            self.add(entry)
+
+    def __contains__(self, entry):
+        return entry in self._positions
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __iter__(self):
+        return (entry for entry in self._entries if entry is not None)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __repr__(self):
+        return f'RecordStore({list(self)!r})'
+
+    def add(self, entry):
+        if entry not in self._positions:
+            self._positions[entry] = len(self._entries)
+            self._entries.append(entry)
+
+    def discard(self, entry):
+        position = self._positions.pop(entry, None)
+        if position is None:
+            return
+        self._entries[position] = None
+        # once holes outnumber entries, keeping it amortized O(1)
+        if len(self._entries) > 2 * len(self._positions):
+            self._entries = [e for e in self._entries if e is not None]
+            self._positions = {e: i for i, e in enumerate(self._entries)}
+
+    def replace(self, old, new):
+        """Puts new in old's place, at the end should old not be there"""
+        position = self._positions.get(old)
+        if position is None or new in self._positions:
+            self.discard(old)
+            self.add(new)
+            return
+        del self._positions[old]
+        self._positions[new] = position
+        self._entries[position] = new
+
+
+class AddressTable(object):
+    """IP addresses parsed once into compact columns
+
+    Addresses are packed into 4 or 16 byte slots of per-version bytearrays
+    and referred to by their position. Anything that wouldn't survive the
+    round trip, non-canonical or invalid addresses, keeps its original text
+    and invalid ones have version 0.
+    """
+
+    _FAMILIES = {4: AF_INET, 6: AF_INET6}
+    _SIZES = {4: 4, 6: 16}
+
+    def __init__(self, ips=()):
+        self._packed = {4: bytearray(), 6: bytearray()}
+        self._slots = array('I')
+        self._verbatim = {}
+        self._versions = array('B')
+
+        for ip in ips:
+            self.append(ip)
+
+    def __len__(self):
+        return len(self._versions)
+
+    def append(self, ip):
+        """Parses and adds ip, returning its position"""
+        i = len(self._versions)
+        version = 6 if ':' in ip else 4
+        try:
+            packed = inet_pton(self._FAMILIES[version], ip)
+            canonical = inet_ntop(self._FAMILIES[version], packed)
+        except OSError:
+            version = 0
+            canonical = None
+            self._slots.append(0)
+        else:
+            column = self._packed[version]
+            self._slots.append(len(column) // self._SIZES[version])
+            column += packed
+        self._versions.append(version)
+
+        if canonical != ip:
+            self._verbatim[i] = ip
+
+        return i
+
+    def ip(self, i):
+        try:
+            return self._verbatim[i]
+        except KeyError:
+            pass
+
+        version = self._versions[i]
+        size = self._SIZES[version]
+        start = self._slots[i] * size
+        packed = bytes(self._packed[version][start : start + size])
+        return inet_ntop(self._FAMILIES[version], packed)
+
+    def version(self, i):
+        return self._versions[i]
+
+
+class ZoneIndex(object):
+    """Label tree of Pi-hole hosts and CNAME entries
+
+    Pi-hole has no concept of zones, its lists are flat. Entries are filed
+    under their name's labels, right to left, so that everything within a
+    zone is found by walking to the zone's node and collecting its subtree,
+    touching only the entries that belong to it. The tree spells out the
+    names so only the addresses are kept, in an AddressTable the nodes refer
+    to by position. Entries with invalid addresses can't be records and are
+    left out, see invalid.
+    """
+
+    class _Node(object):
+        # Members are only allocated once needed and a lone host, by far the
+        # most common case, is held as its position rather than a list
+        __slots__ = ('children', 'cnames', 'hosts')
+
+        def __init__(self):
+            self.children = None
+            self.cnames = None
+            self.hosts = None
+
+    def __init__(self, hosts=(), cnames=(), zones=None):
+        self._root = self._Node()
+        self.addresses = AddressTable()
+        self.invalid = []
+        self.zones = zones
+        # Nodes of the zones entries are limited to, if any
+        self._zones = None
+        if zones is not None:
+            self._zones = {self._node(zone) for zone in zones}
+
+        for entry in hosts:
+            self.add_host(entry)
+        for entry in cnames:
+            self.add_cname(entry)
+
+    def add_host(self, entry):
+        ip, name = entry.split(' ', 1)
+        node = self._node(name)
+        if node is None:
+            return
+
+        i = self.addresses.append(ip)
+        if not self.addresses.version(i):
+            self.invalid.append(entry)
+            return
+        match node.hosts:
+            case None:
+                node.hosts = i
+            case int(j):
+                node.hosts = [j, i]
+            case _:
+                node.hosts.append(i)
+
+    def add_cname(self, entry):
+        name, target = entry.split(',', 1)
+        node = self._node(name)
+        if node is None:
+            return
+
+        if node.cnames is None:
+            node.cnames = [intern(target)]
+        else:
+            node.cnames.append(intern(target))
+
+    def covers(self, zone_name):
+        """Whether all of zone_name's entries are in the index"""
+        if self.zones is None:
+            return True
+        return any(
+            zone_name == zone or zone_name.endswith(f'.{zone}')
+            for zone in self.zones
+        )
+
+    def _node(self, name):
+        """Returns name's node, None when it is outside of zones"""
+        node = self._root
+        inside = self._zones is None
+        for label in reversed(name.split('.')):
+            if node.children is None:
+                node.children = {}
+            try:
+                node = node.children[label]
+            except KeyError:
+                if not inside:
+                    return None
+                child = node.children[label] = self._Node()
+                node = child
+            inside = inside or node in self._zones
+        return node
+
+    def records(self, zone_name):
+        """Yields (name, A ips, AAAA ips, cname targets) for each name within
+        zone_name
+
+        Names are relative to the zone, '' being the zone's apex.
+        """
+        node = self._root
+        for label in reversed(zone_name.split('.')):
+            node = (node.children or {}).get(label)
+            if node is None:
+                return
+
+        addresses = self.addresses
+        stack = [(node, ())]
+        while stack:
+            node, labels = stack.pop()
+            if node.hosts is not None or node.cnames:
+                a = []
+                aaaa = []
+                match node.hosts:
+                    case None:
+                        positions = ()
+                    case int(i):
+                        positions = (i,)
+                    case _:
+                        positions = node.hosts
+                for i in positions:
+                    if addresses.version(i) == 4:
+                        a.append(addresses.ip(i))
+                    else:
+                        aaaa.append(addresses.ip(i))
+                name = '.'.join(reversed(labels))
+                yield name, a, aaaa, node.cnames or []
+            if node.children:
+                for label, child in node.children.items():
+                    stack.append((child, labels + (label,)))
+
+
+class Instrumentation(object):
+    """Times Pi-hole requests and provider phases
+
+    Shared by a provider's clients, it totals every request per method and
+    endpoint and every phase, e.g. populate or _apply, for summary. When set
+    metrics is called as metrics(name, value, tags) for each of
+
+    - request.seconds, request.sent, request.received and request.retries,
+      tagged with url, method, endpoint and status
+    - phase.seconds, tagged with phase and zone
+
+    which map directly onto statsd or Prometheus textfile metrics.
+    """
+
+    def __init__(self, metrics=None):
+        self.log = logging.getLogger('PiholeInstrumentation')
+        self.metrics = metrics
+        self._lock = Lock()
+        # (method, endpoint): [count, seconds, slowest, sent, received,
+        # retries]
+        self._requests = {}
+        # phase: [count, seconds, slowest]
+        self._phases = {}
+
+    @staticmethod
+    def endpoint(path):
+        # a metric per entry would be of little use and unbounded
+        return '/'.join(path.split('/', 5)[:5])
+
+    def _emit(self, name, value, tags):
+        try:
+            self.metrics(name, value, tags)
+        except Exception as e:
+            self.log.warning('metrics: failed to report %s: %s', name, e)
+
+    def request(
+        self, url, method, path, status, seconds, sent, received, retries
+    ):
+        endpoint = self.endpoint(path)
+        self.log.debug(
+            'request: %s %s%s status=%d seconds=%.3f sent=%d received=%d '
+            'retries=%d',
+            method,
+            url,
+            path,
+            status,
+            seconds,
+            sent,
+            received,
+            retries,
+        )
+        with self._lock:
+            totals = self._requests.setdefault(
+                (method, endpoint), [0, 0, 0, 0, 0, 0]
+            )
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            totals[3] += sent
+            totals[4] += received
+            totals[5] += retries
+
+        if self.metrics:
+            tags = {
+                'url': url,
+                'method': method,
+                'endpoint': endpoint,
+                'status': status,
+            }
+            self._emit('request.seconds', seconds, tags)
+            self._emit('request.sent', sent, tags)
+            self._emit('request.received', received, tags)
+            self._emit('request.retries', retries, tags)
+
+    @contextmanager
+    def phase(self, name, zone):
+        """Times the body of the with statement as phase name of zone"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            self.log.debug('phase: %s of %s took %.3fs', name, zone, seconds)
+            with self._lock:
+                totals = self._phases.setdefault(name, [0, 0, 0])
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] = max(totals[2], seconds)
+            if self.metrics:
+                self._emit(
+                    'phase.seconds', seconds, {'phase': name, 'zone': zone}
+                )
+
+    def summary(self):
+        """Returns a table of the totals so far, None if there are none"""
+        if not self._requests and not self._phases:
+            return None
+
+        lines = [
+            f'{"request":<32} {"count":>6} {"seconds":>9} {"slowest":>9} '
+            f'{"sent":>10} {"received":>10} {"retries":>7}'
+        ]
+        with self._lock:
+            for (method, endpoint), totals in sorted(self._requests.items()):
+                count, seconds, slowest, sent, received, retries = totals
+                lines.append(
+                    f'{method + " " + endpoint:<32} {count:>6} '
+                    f'{seconds:>9.3f} {slowest:>9.3f} {sent:>10} '
+                    f'{received:>10} {retries:>7}'
+                )
+            lines.append(
+                f'{"phase":<32} {"count":>6} {"seconds":>9} {"slowest":>9}'
+            )
+            for name, (count, seconds, slowest) in sorted(self._phases.items()):
+                lines.append(
+                    f'{name:<32} {count:>6} {seconds:>9.3f} {slowest:>9.3f}'
+                )
+        return '\n'.join(lines)
+
+
 class PiholeClient(object):
-    def __init__(self, url, password, totp=None, tls_verify=True):
+    """Pi-hole's DNS config over its HTTP API
+
+    Also the interface of the provider's backends, a backend being a
+    subclass that overrides the I/O: _authorize, authorized and logout for
+    sessions, _fetch_snapshot and _stream_snapshot for reading the hosts
+    and cnameRecords lists, and _patch and _update_item for writing them.
+    See AioPiholeClient and PiholeFileClient.
+    """
+
+    # Renew the session this many seconds before Pi-hole would expire it
+    SESSION_REFRESH_MARGIN = 30
+
+    # Used unless given explicitly or through timeout
+    DEFAULT_CONNECT_TIMEOUT = 10
+    # Generous as applying changes waits on FTL reloading its config
+    DEFAULT_READ_TIMEOUT = 120
+
+    # Read size and the lists picked out when streaming the DNS config
+    STREAM_CHUNK_SIZE = 64 * 1024
+    STREAM_LISTS = (
+        ('config', 'dns', 'hosts'),
+        ('config', 'dns', 'cnameRecords'),
+    )
+
+    # How update sends changes: auto picks per update using the costs below,
+    # items always uses per entry calls and patch always replaces lists
+    UPDATE_MODES = ('auto', 'items', 'patch')
+    # Rough costs, in requests. Each per entry call is a request of its own
+    # plus a reload of FTL's config, a PATCH is one of each however many
+    # entries it carries, with every ~1000 entries weighing about a request.
+    ITEM_COST = 2
+    PATCH_COST = 1
+    PATCH_ENTRY_COST = 0.001
+    # Per entry calls are made, and their progress logged, this many at a
+    # time
+    ITEM_CHUNK = 1000
+
+    # Transient failures worth retrying, for idempotent methods only
+    RETRY_METHODS = frozenset(('DELETE', 'GET'))
+    RETRY_STATUSES = frozenset((429, 502, 503, 504))
+
+    def __init__(
+        self,
+        url,
+        password,
+        totp=None,
+        tls_verify=True,
+        snapshot_ttl=300,
+        timeout=None,
+        connect_timeout=None,
+        read_timeout=None,
+        retries=3,
+        backoff_factor=0.5,
+        max_connections=8,
+        cache_dir=None,
+        cache_ttl=300,
+        stream=False,
+        stream_zones=(),
+        update_mode='auto',
+        merge=False,
+        merge_attempts=3,
+        instrumentation=None,
+        compress=False,
+        max_patch_size=None,
+    ):
+        if update_mode not in self.UPDATE_MODES:
+            raise PiholeClientException(f'Unknown update mode "{update_mode}"')
+
         session = Session()
         session.verify = tls_verify
 
+        # Connection errors are retried for every method as the request
+        # never made it, everything else only for idempotent ones so that
+        # an update is never sent twice. Sleeps between attempts grow
+        # exponentially with jitter to spread out retrying clients.
+        adapter = HTTPAdapter(
+            pool_maxsize=max_connections,
+            max_retries=Retry(
+                total=retries,
+                allowed_methods=self.RETRY_METHODS,
+                status_forcelist=self.RETRY_STATUSES,
+                backoff_factor=backoff_factor,
+                backoff_jitter=backoff_factor,
+                raise_on_status=False,
+            ),
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
         session.headers.update(
             {
                 'accept': 'application/json',
@@ -43,13 +720,76 @@ class PiholeClient(object):
             }
         )
 
+        self.log = logging.getLogger(f'PiholeClient[{url}]')
+        self.instrumentation = instrumentation or Instrumentation()
         self._password = password
         self._session = session
         self._totp = totp
         self._url = url
+        self.max_connections = max_connections
+        self.update_mode = update_mode
+        # Merge changes into Pi-hole's current lists rather than overwriting
+        # them with ours, see _merge_update
+        self.merge = merge
+        self.merge_attempts = merge_attempts
+        # gzip PATCH bodies, dropped should Pi-hole refuse one, see _patch
+        self.compress = compress
+        # PATCH bodies over this many bytes are sent as per entry calls
+        # instead, when there's a delta to send
+        self.max_patch_size = max_patch_size
+        # (connect, read) as expected by requests
+        self.timeout = (
+            connect_timeout or timeout or self.DEFAULT_CONNECT_TIMEOUT,
+            read_timeout or timeout or self.DEFAULT_READ_TIMEOUT,
+        )
 
-        self._cname_cache = []
-        self._host_cache = []
+        self._cname_cache = RecordStore()
+        self._host_cache = RecordStore()
+
+        # The DNS config is fetched once and shared by every zone for up to
+        # snapshot_ttl seconds or until the next apply, see snapshot()
+        self.snapshot_ttl = snapshot_ttl
+        self._snapshot = None
+        self._snapshot_at = 0
+        self._snapshot_lock = Lock()
+        # (snapshot, ZoneIndex) built on demand by zone_records
+        self._index = None
+
+        # The last snapshot fetched, {fetched_at, hash, snapshot}, persisted
+        # to cache_dir when set and used in place of fetching for up to
+        # cache_ttl seconds, see _load_snapshot
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self._cached = self._read_cache() if cache_dir else None
+        # False while the snapshot is from disk and unconfirmed by Pi-hole
+        self._verified = True
+
+        # With stream, zone_records is served by a ZoneIndex of just
+        # stream_zones' entries, parsed as the DNS config is downloaded
+        # rather than from a snapshot, see _streamed_index
+        self.stream = stream
+        self.stream_zones = set(stream_zones)
+        self._streamed = None
+        self._streamed_at = 0
+
+        # Cache modifications not yet sent to Pi-hole, see pending, and the
+        # lists they touched
+        self._pending = 0
+        self._pending_since = None
+        self._dirty = set()
+        # Fingerprints of the snapshot's lists, computed on demand
+        self._fingerprints = {}
+
+        # Session lifecycle, see _authorize/logout
+        self._session_expires = 0
+        self.login_count = 0
+
+    @property
+    def authorized(self):
+        return (
+            'sid' in self._session.headers
+            and monotonic() < self._session_expires
+        )
 
     def _authorize(self):
         path = "/api/auth"
@@ -61,20 +801,65 @@ class PiholeClient(object):
             auth_required=False,
         ).json()
         try:
-            self._session.headers["sid"] = data["session"]["sid"]
+            sid = data["session"]["sid"]
+            validity = data["session"]["validity"]
         except KeyError:
             raise PiholeClientException('Unexpected authorization response')
 
+        self._session.headers["sid"] = sid
+        self._session_expires = (
+            monotonic() + validity - self.SESSION_REFRESH_MARGIN
+        )
+        self.login_count += 1
+
+    def _forget_session(self):
+        self._session.headers.pop('sid', None)
+        self._session_expires = 0
+
     def _request(
-        self, method, path, params=None, data=None, auth_required=True
+        self,
+        method,
+        path,
+        params=None,
+        data=None,
+        auth_required=True,
+        retry_unauthorized=True,
+        stream=False,
+        body=None,
+        headers=None,
     ):
-        if auth_required:
+        if auth_required and not self.authorized:
             self._authorize()
 
         url = f"{self._url}{path}"
-        resp = self._session.request(method, url, params=params, json=data)
+        start = perf_counter()
+        resp = self._session.request(
+            method,
+            url,
+            params=params,
+            json=data,
+            data=body,
+            headers=headers,
+            timeout=self.timeout,
+            stream=stream,
+        )
+        self._instrument(method, path, resp, perf_counter() - start, stream)
 
         match resp.status_code:
+            case 401 if auth_required and retry_unauthorized:
+                # The session was expired or revoked server side, log in
+                # again and give the request one more try
+                self._forget_session()
+                return self._request(
+                    method,
+                    path,
+                    params=params,
+                    data=data,
+                    retry_unauthorized=False,
+                    stream=stream,
+                    body=body,
+                    headers=headers,
+                )
             case 401:
                 raise PiholeClientUnauthorized()
             case 404:
@@ -83,68 +868,608 @@ class PiholeClient(object):
         resp.raise_for_status()
         return resp
 
-    def add_cname_record(self, name, target):
-        entry = f"{name},{target}"
+    def _instrument(self, method, path, resp, seconds, stream):
+        # a streamed body hasn't been read yet, go by what it claims
+        if stream:
+            received = int(resp.headers.get('Content-Length', 0))
+        else:
+            received = len(resp.content)
+        # urllib3 records the attempts it retried
+        retries = resp.raw.retries
+        self.instrumentation.request(
+            self._url,
+            method,
+            path,
+            resp.status_code,
+            seconds,
+            len(resp.request.body or b''),
+            received,
+            len(retries.history) if retries else 0,
+        )
 
-        # avoid duplication
-        if not entry in self._cname_cache:
-            self._cname_cache.append(entry)
+    @property
+    def pending(self):
+        """Number of cache modifications not yet applied to Pi-hole"""
+        return self._pending
+
+    @property
+    def pending_age(self):
+        """Seconds since the oldest modification not yet applied"""
+        if not self._pending:
+            return 0
+        return monotonic() - self._pending_since
+
+    def _editing(self):
+        # Edits must start from all of Pi-hole's entries, which a streamed
+        # index doesn't hold on to, and after an update from what it now
+        # holds, so that the next delta, and with it merge, update_mode and
+        # skipping unchanged lists, is against Pi-hole rather than None
+        if self._snapshot is None:
+            self.snapshot()
+
+    def _modified(self, key):
+        if not self._pending:
+            self._pending_since = monotonic()
+        self._pending += 1
+        self._dirty.add(key)
+
+    def _changed(self, key, cache):
+        if key not in self._dirty:
+            return False
+        return fingerprint(cache) != self._snapshot_fingerprint(key)
+
+    def _snapshot_fingerprint(self, key):
+        # edits, and so dirty lists, always have a snapshot, see _editing
+        try:
+            return self._fingerprints[key]
+        except KeyError:
+            hosts, cnames = self._snapshot
+            entries = hosts if key == 'hosts' else cnames
+            value = self._fingerprints[key] = fingerprint(entries)
+            return value
 
-    def add_host_record(self, ip, name):
-        entry = f"{ip} {name}"
+    def add_cname_record(self, name, target):
+        self._editing()
+        self._cname_cache.add(f"{name},{target}")
+        self._modified('cnameRecords')
 
-        # avoid duplication
-        if not entry in self._host_cache:
-            self._host_cache.append(entry)
+    def add_host_record(self, ip, name):
+        self._editing()
+        self._host_cache.add(f"{ip} {name}")
+        self._modified('hosts')
 
     def apply(self):
-        """Applies the cache updates to Pi-Hole"""
-        path = "/api/config"
-
-        payload = {
-            "config": {
-                "dns": {
-                    "cnameRecords": self._cname_cache,
-                    "hosts": self._host_cache,
-                }
+        """Applies the cache updates to Pi-Hole, see changes"""
+        dns = self.changes()
+        if dns:
+            self.update(dns, self.delta(dns))
+
+    def changes(self):
+        """Returns the lists to send to Pi-hole and marks them as sent
+
+        Only lists that differ from the snapshot they were fetched with are
+        included and nothing is when neither does, e.g. when a record was
+        deleted and re-created.
+        """
+        dns = {}
+        for key, cache in (
+            ('cnameRecords', self._cname_cache),
+            ('hosts', self._host_cache),
+        ):
+            if self._changed(key, cache):
+                dns[key] = list(cache)
+            else:
+                self.log.info(
+                    'changes: %s unchanged, skipped %d entries, ~%d bytes',
+                    key,
+                    len(cache),
+                    # as encoded, each quoted and separated, in brackets
+                    max(sum(len(e) + 4 for e in cache), 2),
+                )
+
+        self._pending = 0
+        self._dirty.clear()
+
+        if not dns:
+            self.log.info('changes: no net changes, skipping update')
+
+        return dns
+
+    def delta(self, dns):
+        """Returns {list: (added, removed)} between the snapshot and dns
+
+        None when there's no snapshot to compare with. Must be called before
+        the snapshot is invalidated, i.e. before update.
+        """
+        if self._snapshot is None:
+            return None
+
+        hosts, cnames = self._snapshot
+        delta = {}
+        for key, entries in dns.items():
+            before = hosts if key == 'hosts' else cnames
+            existing = set(before)
+            after = set(entries)
+            delta[key] = (
+                [e for e in entries if e not in existing],
+                [e for e in before if e not in after],
+            )
+        return delta
+
+    def _choose_update(self, dns, delta):
+        if delta is None:
+            return 'patch'
+        if self.update_mode != 'auto':
+            return self.update_mode
+
+        changes = sum(len(a) + len(r) for a, r in delta.values())
+        entries = sum(len(e) for e in dns.values())
+        items = changes * self.ITEM_COST
+        patch = self.PATCH_COST + entries * self.PATCH_ENTRY_COST
+        self.log.debug(
+            '_choose_update: %d changes cost %.1f, %d entries cost %.1f',
+            changes,
+            items,
+            entries,
+            patch,
+        )
+        return 'items' if items < patch else 'patch'
+
+    def _update_item(self, method, key, entry):
+        path = f"/api/config/dns/{key}/{quote(entry, safe='')}"
+        try:
+            self._request(method, path)
+        except PiholeClientNotFound:
+            if method != 'DELETE':
+                raise
+            # already gone
+
+    def _update_items(self, delta):
+        # Log in up front rather than have every call race to
+        if not self.authorized:
+            self._authorize()
+
+        total = sum(len(a) + len(r) for a, r in delta.values())
+        # only worth mentioning when it takes more than a chunk
+        progress = self.log.info if total > self.ITEM_CHUNK else self.log.debug
+        done = 0
+        # Removals first, e.g. a CNAME being replaced, then additions, each
+        # as concurrent calls
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            for method, which in (('DELETE', 1), ('PUT', 0)):
+                entries = [
+                    (key, entry)
+                    for key, changes in delta.items()
+                    for entry in changes[which]
+                ]
+                for i in range(0, len(entries), self.ITEM_CHUNK):
+                    futures = [
+                        executor.submit(self._update_item, method, key, entry)
+                        for key, entry in entries[i : i + self.ITEM_CHUNK]
+                    ]
+                    for future in futures:
+                        future.result()
+                    done += len(futures)
+                    progress('_update_items: %d/%d entries sent', done, total)
+
+    def _patch(self, body):
+        """Sends body, a PatchBody, compressed when compress is set"""
+        path = '/api/config'
+        headers = {'Content-Type': 'application/json'}
+        if self.compress:
+            try:
+                return self._request(
+                    'PATCH',
+                    path,
+                    body=body.compressed(),
+                    headers={**headers, 'Content-Encoding': 'gzip'},
+                )
+            except HTTPError as e:
+                # Pi-hole's webserver either accepts it or fails to parse
+                # the body
+                if e.response.status_code not in (400, 415):
+                    raise
+                self.log.warning(
+                    '_patch: compressed body refused, sending uncompressed'
+                )
+                self.compress = False
+        self._request('PATCH', path, body=body, headers=headers)
+
+    def update(self, dns, delta=None):
+        """Replaces Pi-hole's lists with the ones in dns
+
+        Given the delta that produced them, see delta, only the entries
+        that changed may be sent instead, see UPDATE_MODES, as they are when
+        the lists would be over max_patch_size bytes. Should any of those
+        calls fail the lists are sent whole.
+        """
+        merging = self.merge and delta is not None
+
+        if not self._verified and not merging:
+            # Changes were planned against a snapshot from disk, make sure
+            # Pi-hole still matches it before overwriting anything
+            if content_hash(*self._fetch_snapshot()) != self._cached['hash']:
+                raise PiholeClientException(
+                    'Pi-hole changed since the cached snapshot was taken'
+                )
+            self._verified = True
+
+        body = PatchBody(dns, self.STREAM_CHUNK_SIZE)
+        mode = self._choose_update(dns, delta)
+        if (
+            mode == 'patch'
+            and delta is not None
+            and self.max_patch_size
+            and len(body) > self.max_patch_size
+        ):
+            self.log.info(
+                'update: %d byte body is over max_patch_size, sending %s '
+                'entry by entry',
+                len(body),
+                ', '.join(delta),
+            )
+            mode = 'items'
+        if mode == 'items':
+            try:
+                self._update_items(delta)
+                dns = None
+            except Exception as e:
+                self.log.warning(
+                    'update: per entry calls failed, sending lists: %s', e
+                )
+        if dns is not None and merging:
+            self._merge_update(delta)
+        elif dns is not None:
+            self._patch(body)
+        self.invalidate()
+        self._forget_cache()
+
+    def _merge_update(self, delta):
+        """Sends delta merged into Pi-hole's current lists
+
+        Pi-hole has no conditional writes so the lists are fetched, merged
+        and sent, then fetched again to confirm our changes stuck, retrying
+        up to merge_attempts times when they didn't. That only catches
+        writers undoing our changes, entries others add or remove between
+        the fetch and the PATCH are overwritten unnoticed. Per entry calls,
+        see update_mode, leave them alone. Additions conflicting with what
+        others did raise PiholeClientConflict rather than being sent.
+        """
+        attempts = 0
+        while True:
+            hosts, cnames = self._fetch_snapshot()
+            remote = {'hosts': hosts, 'cnameRecords': cnames}
+            merged = {
+                key: merge_lists(remote[key], added, removed)
+                for key, (added, removed) in delta.items()
             }
-        }
+            dns = {
+                key: entries
+                for key, entries in merged.items()
+                if entries != remote[key]
+            }
+            if not dns:
+                self.log.debug('_merge_update: in place after %d', attempts)
+                return
+            if attempts == self.merge_attempts:
+                raise PiholeClientConflict(
+                    f'Changes did not stick after {attempts} attempts'
+                )
+            attempts += 1
+
+            remote.update(merged)
+            conflicts = merge_conflicts(
+                remote['hosts'],
+                remote['cnameRecords'],
+                delta.get('hosts', ((), ()))[0],
+                delta.get('cnameRecords', ((), ()))[0],
+            )
+            if conflicts:
+                raise PiholeClientConflict(
+                    f'Conflicting changes to {", ".join(conflicts)}'
+                )
 
-        self._request('PATCH', path, data=payload)
+            self.log.info('_merge_update: sending %s', ', '.join(dns))
+            self._patch(PatchBody(dns, self.STREAM_CHUNK_SIZE))
+
+    def logout(self):
+        """Ends the current session, if any, freeing its Pi-hole slot"""
+        if 'sid' not in self._session.headers:
+            return
 
-    def delete_cname_record(self, name, target):
         try:
-            self._cname_cache.remove(f"{name},{target}")
-        except ValueError:
+            self._request('DELETE', '/api/auth', auth_required=False)
+        except PiholeClientUnauthorized:
+            # already expired or revoked
             pass
+        finally:
+            self._forget_session()
+
+    def replace_cname_record(self, name, target, new_target):
+        self._editing()
+        self._cname_cache.replace(f"{name},{target}", f"{name},{new_target}")
+        self._modified('cnameRecords')
+
+    def delete_cname_record(self, name, target):
+        self._editing()
+        self._cname_cache.discard(f"{name},{target}")
+        self._modified('cnameRecords')
 
     def delete_host_record(self, ip, name):
-        try:
-            self._host_cache.remove(f"{ip} {name}")
-        except ValueError:
-            pass
+        self._editing()
+        self._host_cache.discard(f"{ip} {name}")
+        self._modified('hosts')
 
     def get_cname_records(self):
-        path = "/api/config/dns/cnameRecords"
+        _, cnames = self.snapshot()
+        return list(cnames)
+
+    def get_host_records(self):
+        hosts, _ = self.snapshot()
+        return list(hosts)
+
+    def invalidate(self):
+        """Drops the snapshot, the next read will fetch a fresh one
+
+        Kept while there are pending modifications as a fresh one would
+        reset the caches they were made to, see snapshot.
+        """
+        with self._snapshot_lock:
+            if self._pending:
+                self.log.debug(
+                    'invalidate: keeping snapshot, %d changes pending',
+                    self._pending,
+                )
+                return
+            self._snapshot = None
+            self._streamed = None
+
+    def snapshot(self):
+        """Returns the (hosts, cnameRecords) lists of Pi-hole's DNS config
+
+        Both lists come from a single request which is reused until it is
+        older than snapshot_ttl seconds or invalidated by apply. Fetching a
+        new snapshot resets the caches that apply will send so a stale one is
+        kept while there are pending modifications.
+        """
+        with self._snapshot_lock:
+            stale = monotonic() - self._snapshot_at > self.snapshot_ttl
+            if self._snapshot is None or (stale and not self._pending):
+                snapshot = self._load_snapshot()
+                self._snapshot_at = monotonic()
+                # Unchanged content keeps its caches and index
+                if snapshot is not self._snapshot:
+                    self._snapshot = hosts, cnames = snapshot
+                    self._fingerprints = {}
+                    self._host_cache = RecordStore(hosts)
+                    self._cname_cache = RecordStore(cnames)
+
+            return self._snapshot
+
+    @property
+    def _cache_path(self):
+        key = sha256(self._url.encode()).hexdigest()[:16]
+        return join(self.cache_dir, f'pihole-{key}.json')
+
+    def _read_cache(self):
+        try:
+            with open(self._cache_path) as fh:
+                data = load(fh)
+            if data['url'] != self._url:
+                return None
+            return {
+                'fetched_at': data['fetched_at'],
+                'hash': data['hash'],
+                'snapshot': (data['hosts'], data['cnameRecords']),
+            }
+        except (OSError, ValueError, KeyError) as e:
+            self.log.debug('_read_cache: ignoring cache, %s', e)
+            return None
+
+    def _write_cache(self):
+        hosts, cnames = self._cached['snapshot']
+        makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as fh:
+            dump(
+                {
+                    'url': self._url,
+                    'fetched_at': self._cached['fetched_at'],
+                    'hash': self._cached['hash'],
+                    'hosts': hosts,
+                    'cnameRecords': cnames,
+                },
+                fh,
+                separators=(',', ':'),
+            )
+        replace(tmp, path)
+
+    def _forget_cache(self):
+        self._cached = None
+        if self.cache_dir:
+            try:
+                unlink(self._cache_path)
+            except FileNotFoundError:
+                pass
+
+    def _load_snapshot(self):
+        cached = self._cached
+        if self.cache_dir and cached:
+            age = time() - cached['fetched_at']
+            if age < self.cache_ttl:
+                self.log.debug('_load_snapshot: using %.0fs old cache', age)
+                self._verified = False
+                return cached['snapshot']
+
+        hosts, cnames = self._fetch_snapshot()
+        digest = content_hash(hosts, cnames)
+        if cached and cached['hash'] == digest:
+            # Same content as before, keep the lists already in use
+            snapshot = cached['snapshot']
+        else:
+            snapshot = (hosts, cnames)
+
+        self._cached = {
+            'fetched_at': time(),
+            'hash': digest,
+            'snapshot': snapshot,
+        }
+        self._verified = True
+        if self.cache_dir:
+            self._write_cache()
+
+        return snapshot
+
+    def zone_records(self, zone_name):
+        """Yields (name, A ips, AAAA ips, cname targets) for each name
+        within zone_name
+
+        See ZoneIndex.records, the index is built once per snapshot or, with
+        stream, streamed while no snapshot is needed for changes.
+        """
+        if self.stream and self._snapshot is None:
+            return self._streamed_index(zone_name).records(zone_name)
+
+        snapshot = self.snapshot()
+        with self._snapshot_lock:
+            if self._index is None or self._index[0] is not snapshot:
+                index = ZoneIndex(*snapshot)
+                for entry in index.invalid:
+                    self.log.warning('ignoring invalid hosts entry "%s"', entry)
+                self._index = (snapshot, index)
+            index = self._index[1]
+
+        return index.records(zone_name)
+
+    def _streamed_index(self, zone_name):
+        with self._snapshot_lock:
+            index = self._streamed
+            stale = monotonic() - self._streamed_at > self.snapshot_ttl
+            if index is None or stale or not index.covers(zone_name):
+                self.stream_zones.add(zone_name)
+                index = ZoneIndex(zones=frozenset(self.stream_zones))
+                try:
+                    for key, entry in self._stream_snapshot():
+                        if key == 'hosts':
+                            index.add_host(entry)
+                        else:
+                            index.add_cname(entry)
+                except ValueError:
+                    raise PiholeClientException(
+                        'Unexpected response gathering DNS config'
+                    )
+                for entry in index.invalid:
+                    self.log.warning('ignoring invalid hosts entry "%s"', entry)
+                self._streamed = index
+                self._streamed_at = monotonic()
+            return index
+
+    def _stream_snapshot(self):
+        """Yields ('hosts' or 'cnameRecords', entry) for each of Pi-hole's
+        entries as the DNS config is downloaded"""
+        resp = self._request('GET', '/api/config/dns', stream=True)
+        with resp:
+            chunks = resp.iter_content(self.STREAM_CHUNK_SIZE)
+            for path, entry in iter_json_lists(chunks, self.STREAM_LISTS):
+                yield path[-1], entry
+
+    def _fetch_snapshot(self):
+        path = "/api/config/dns"
 
         resp = self._request('GET', path).json()
         try:
-            self._cname_cache = resp["config"]["dns"]["cnameRecords"]
+            dns = resp["config"]["dns"]
+            return dns["hosts"], dns["cnameRecords"]
         except KeyError:
-            raise PiholeClientException('Unexpected response gathering CNAMEs')
+            raise PiholeClientException(
+                'Unexpected response gathering DNS config'
+            )
 
-        return self._cname_cache.copy()
 
-    def get_host_records(self):
-        path = "/api/config/dns/hosts"
+class PiholeFleet(object):
+    """A primary Pi-hole and its replicas
 
-        resp = self._request('GET', path).json()
+    Reads, and the changes to make, come from the primary client while
+    updates are sent to every member of the fleet concurrently. The outcome
+    for each is kept in results and policy decides which failures raise:
+
+    - all: every member must be updated
+    - primary: the primary must be updated, replica failures are logged
+    - any: at least one member must be updated
+    """
+
+    POLICIES = ('all', 'primary', 'any')
+
+    Result = namedtuple('Result', ('url', 'elapsed', 'error'))
+
+    def __init__(self, clients, policy='all'):
+        if policy not in self.POLICIES:
+            raise PiholeClientException(f'Unknown fleet policy "{policy}"')
+
+        self.log = logging.getLogger('PiholeFleet')
+        self.clients = clients
+        self.policy = policy
+        self.results = []
+
+    def __getattr__(self, name):
+        return getattr(self.clients[0], name)
+
+    def _update(self, client, dns, delta):
+        start = monotonic()
         try:
-            self._host_cache = resp["config"]["dns"]["hosts"]
-        except KeyError:
-            raise PiholeClientException('Unexpected response gathering hosts')
+            client.update(dns, delta)
+            error = None
+        except Exception as e:
+            error = e
+        return self.Result(client._url, monotonic() - start, error)
+
+    def apply(self):
+        dns = self.clients[0].changes()
+        if not dns:
+            return
+        # replicas are expected to match the primary, if they don't entry
+        # calls failing falls back to sending the lists whole
+        delta = self.clients[0].delta(dns)
+
+        with ThreadPoolExecutor(max_workers=len(self.clients)) as executor:
+            futures = [
+                executor.submit(self._update, client, dns, delta)
+                for client in self.clients
+            ]
+            self.results = [f.result() for f in futures]
+
+        failed = 0
+        for result in self.results:
+            if result.error:
+                failed += 1
+                self.log.warning(
+                    'apply: %s failed after %.3fs: %s',
+                    result.url,
+                    result.elapsed,
+                    result.error,
+                )
+            else:
+                self.log.info(
+                    'apply: %s updated in %.3fs', result.url, result.elapsed
+                )
+
+        match self.policy:
+            case 'all':
+                ok = failed == 0
+            case 'primary':
+                ok = not self.results[0].error
+            case _:  # any
+                ok = failed < len(self.results)
+        if not ok:
+            raise PiholeFleetException(self.results)
 
-        return self._host_cache.copy()
+    def logout(self):
+        for client in self.clients:
+            try:
+                client.logout()
+            except Exception as e:
+                self.log.warning('logout: %s failed: %s', client._url, e)
 
 
 class PiholeProvider(BaseProvider):
@@ -155,17 +1480,228 @@ class PiholeProvider(BaseProvider):
     SUPPORTS_ROOT_NS = False
     SUPPORTS = set(('A', 'AAAA', 'CNAME'))
 
+    # Providers not yet closed, finalized together at exit, see _at_exit
+    _open = WeakSet()
+
     def __init__(
-        self, id, url, password, tls_verify=True, totp=None, *args, **kwargs
+        self,
+        id,
+        url,
+        password=None,
+        tls_verify=True,
+        totp=None,
+        snapshot_ttl=300,
+        batch_apply=False,
+        batch_max_changes=None,
+        batch_max_age=None,
+        timeout=None,
+        fleet_policy='all',
+        transport='requests',
+        max_connections=8,
+        connect_timeout=None,
+        read_timeout=None,
+        retries=3,
+        backoff_factor=0.5,
+        cache_dir=None,
+        cache_ttl=300,
+        stream=False,
+        stream_zones=(),
+        update_mode='auto',
+        merge=False,
+        merge_attempts=3,
+        metrics=None,
+        prefetch_zones=(),
+        prefetch_processes=None,
+        compress=False,
+        max_patch_size=None,
+        *args,
+        **kwargs,
     ):
         self.log = logging.getLogger(f'PiholeProvider[{id}]')
         self.log.debug(
-            '__init__: id=%s, url=%s tls_verify=%s', id, url, tls_verify
+            '__init__: id=%s, url=%s tls_verify=%s snapshot_ttl=%s '
+            'batch_apply=%s batch_max_changes=%s batch_max_age=%s '
+            'timeout=%s fleet_policy=%s transport=%s max_connections=%s '
+            'connect_timeout=%s read_timeout=%s retries=%s backoff_factor=%s '
+            'cache_dir=%s cache_ttl=%s stream=%s stream_zones=%s '
+            'update_mode=%s merge=%s merge_attempts=%s metrics=%s '
+            'prefetch_zones=%s prefetch_processes=%s compress=%s '
+            'max_patch_size=%s',
+            id,
+            url,
+            tls_verify,
+            snapshot_ttl,
+            batch_apply,
+            batch_max_changes,
+            batch_max_age,
+            timeout,
+            fleet_policy,
+            transport,
+            max_connections,
+            connect_timeout,
+            read_timeout,
+            retries,
+            backoff_factor,
+            cache_dir,
+            cache_ttl,
+            stream,
+            stream_zones,
+            update_mode,
+            merge,
+            merge_attempts,
+            metrics,
+            prefetch_zones,
+            prefetch_processes,
+            compress,
+            max_patch_size,
         )
         super().__init__(id, *args, **kwargs)
-        self._client = PiholeClient(url, password, totp, tls_verify)
+        self.batch_apply = batch_apply
+        self.batch_max_changes = batch_max_changes
+        self.batch_max_age = batch_max_age
+        # prefetch_zones are prefetched by the first populate of one of them
+        self.prefetch_zones = set(prefetch_zones)
+        self.prefetch_processes = prefetch_processes
+        self._prefetch_lock = Lock()
+        # zone name: the (name, data, valid) of its records, see prefetch
+        self._prefetched = {}
+
+        match transport:
+            case 'requests':
+                client_class = PiholeClient
+            case 'aiohttp':
+                try:
+                    from .aio import AioPiholeClient as client_class
+                except ImportError:
+                    raise ProviderException(
+                        'transport aiohttp requires octodns-pihole[async]'
+                    )
+            case 'file':
+                from .file import PiholeFileClient as client_class
+            case _:
+                # or the dotted path of a PiholeClient subclass
+                module, _, name = transport.rpartition('.')
+                try:
+                    client_class = getattr(import_module(module), name)
+                except (AttributeError, ImportError, ValueError):
+                    raise ProviderException(f'Unknown transport "{transport}"')
+
+        # metrics may be given as the dotted path of a callable, e.g. from
+        # YAML config
+        if isinstance(metrics, str):
+            module, _, name = metrics.rpartition('.')
+            try:
+                metrics = getattr(import_module(module), name)
+            except (AttributeError, ImportError, ValueError):
+                raise ProviderException(f'Unable to load metrics "{metrics}"')
+        self.instrumentation = Instrumentation(metrics)
+
+        # A list of urls is a fleet, the first being the primary
+        urls = [url] if isinstance(url, str) else url
+        clients = [
+            client_class(
+                url,
+                password,
+                totp=totp,
+                tls_verify=tls_verify,
+                snapshot_ttl=snapshot_ttl,
+                timeout=timeout,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+                retries=retries,
+                backoff_factor=backoff_factor,
+                max_connections=max_connections,
+                cache_dir=cache_dir,
+                cache_ttl=cache_ttl,
+                stream=stream,
+                stream_zones=stream_zones,
+                update_mode=update_mode,
+                merge=merge,
+                merge_attempts=merge_attempts,
+                instrumentation=self.instrumentation,
+                compress=compress,
+                max_patch_size=max_patch_size,
+            )
+            for url in urls
+        ]
+        if len(clients) == 1:
+            self._client = clients[0]
+        else:
+            self._client = PiholeFleet(clients, fleet_policy)
+        # Flush deferred changes, log out and summarize the run once the
+        # provider is closed or collected, at exit see _at_exit
+        self._finalizer = finalize(
+            self,
+            PiholeProvider._finalize,
+            self._client,
+            self.log,
+            self.instrumentation,
+        )
+        self._finalizer.atexit = False
+        PiholeProvider._open.add(self)
 
-    def _data_for_multiple(self, type, records):
+    @staticmethod
+    def _finalize(client, log, instrumentation, strict=False):
+        try:
+            if client.pending:
+                log.info('close: sending %d deferred changes', client.pending)
+                client.apply()
+        except Exception as e:
+            if strict:
+                raise
+            log.error('close: failed to send deferred changes: %s', e)
+        finally:
+            try:
+                client.logout()
+            except Exception as e:
+                log.warning('close: failed to log out of Pi-hole: %s', e)
+            summary = instrumentation.summary()
+            if summary:
+                log.info('close: requests and phases\n%s', summary)
+
+    @staticmethod
+    def _at_exit():
+        """Closes the providers still open at interpreter exit
+
+        octoDNS has already reported their deferred changes as applied by
+        then and exceptions raised from exit handlers don't change the exit
+        status. So every provider is closed, output flushed, and only then,
+        should any have failed to send its changes, does it exit with 1.
+        """
+        failed = 0
+        for provider in list(PiholeProvider._open):
+            try:
+                provider.close()
+            except Exception as e:
+                failed += 1
+                provider.log.error(
+                    'close: failed to send deferred changes at exit: %s', e
+                )
+        if failed:
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except (AttributeError, ValueError):
+                    # gone or closed
+                    pass
+            logging.shutdown()
+            _exit(1)
+
+    def close(self):
+        """Sends any deferred changes and releases the Pi-hole session
+
+        Failing to send deferred changes raises here, when left to garbage
+        collection they can only be logged and at interpreter exit they
+        make it exit with 1, see _at_exit.
+        """
+        PiholeProvider._open.discard(self)
+        if self._finalizer.detach():
+            self._finalize(
+                self._client, self.log, self.instrumentation, strict=True
+            )
+
+    @staticmethod
+    def _data_for_multiple(type, records):
         return {
             'ttl': PiholeProvider.DEFAULT_TTL,
             'type': type,
@@ -175,7 +1711,8 @@ class PiholeProvider(BaseProvider):
     _data_for_A = _data_for_multiple
     _data_for_AAAA = _data_for_multiple
 
-    def _data_for_CNAME(self, _type, records):
+    @staticmethod
+    def _data_for_CNAME(_type, records):
         record = records[0]
         return {
             'ttl': PiholeProvider.DEFAULT_TTL,
@@ -183,16 +1720,70 @@ class PiholeProvider(BaseProvider):
             'value': f'{record}',
         }
 
-    def _process_desired_zone(self, desired):
-        # TTL is not supported for records in Pi-hole.
-        # Reset desired records TTL to a known default to
-        # ignore the source provider and prevent false changes.
-        for record in desired.records:
-            record = record.copy()
-            record.ttl = PiholeProvider.DEFAULT_TTL
-            desired.add_record(record, replace=True)
-
-        return super()._process_desired_zone(desired)
+    def _include_change(self, change):
+        # Pi-hole only holds values, an update changing anything else, e.g.
+        # the unsupported TTL or geo, would be a false change. Filtering
+        # these out rather than resetting desired's TTLs spares copying
+        # every record.
+        match change:
+            case Update(existing=existing, new=new):
+                return any(
+                    existing.data.get(key) != new.data.get(key)
+                    for key in ('value', 'values')
+                )
+        return True
+
+    @staticmethod
+    def _record_data(zone_name, records):
+        """Returns (name, data, valid) for each record of zone_name's (name,
+        a, aaaa, targets) records, valid when it passes Record.new's checks
+
+        A staticmethod so that it can run in a worker process.
+        """
+        types = Record.registered_types()
+        ret = []
+        for name, a, aaaa, targets in records:
+            for _type, values in (('A', a), ('AAAA', aaaa), ('CNAME', targets)):
+                if not values:
+                    continue
+                data = getattr(PiholeProvider, f'_data_for_{_type}')(
+                    _type, values
+                )
+                try:
+                    encoded = idna_encode(name)
+                except IdnaError:
+                    ret.append((name, data, False))
+                    continue
+                fqdn = f'{encoded}.{zone_name}' if encoded else zone_name
+                valid = not (
+                    ' ' in encoded
+                    or '\t' in encoded
+                    or types[_type].validate(encoded, fqdn, data)
+                )
+                ret.append((name, data, valid))
+        return ret
+
+    def prefetch(self, zone_names, processes=None):
+        """Builds the record data of every one of zone_names up front
+
+        The snapshot is partitioned by zone in a single pass and each zone's
+        record data built and validated, across that many worker processes
+        when processes is set, leaving the next populate of each zone only
+        to create and add its records. What isn't used is dropped by _apply.
+        """
+        zone_names = list(zone_names)
+        # one streamed index covering them all
+        self._client.stream_zones.update(zone_names)
+        partitions = [list(self._client.zone_records(n)) for n in zone_names]
+
+        if processes:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                data = list(
+                    executor.map(self._record_data, zone_names, partitions)
+                )
+        else:
+            data = map(self._record_data, zone_names, partitions)
+        self._prefetched.update(zip(zone_names, data))
 
     def populate(self, zone, target=False, lenient=False):
         self.log.debug(
@@ -202,59 +1793,115 @@ class PiholeProvider(BaseProvider):
             lenient,
         )
 
-        values = defaultdict(lambda: defaultdict(list))
-
-        # A/AAAA "records"
-        for entry in self._client.get_host_records():
-            ip, name = entry.split(' ', 1)
-
-            # Pi-hole does not really have the concept of zones
-            # we only want to return "records" within the zone
-            if zone.name not in name:
-                continue
-
-            # Strip the zone name from the list entry
-            name = name.split(zone.name, 1)[0].rstrip('.')
-
-            match ip_address(ip).version:
-                case 4:
-                    values[name]['A'].append(ip)
-                case 6:  # pragma: no cover (this is tested but coverage warns)
-                    values[name]['AAAA'].append(ip)
-
-        # CNAME "records"
-        for entry in self._client.get_cname_records():
-            name, target = entry.split(',', 1)
-
-            # Pi-hole does not really have the concept of zones
-            # we only want to return "records" within the zone
-            if zone.name not in name:
-                continue
-
-            # Strip the zone name from the list entry
-            name = name.split(f".{zone.name}", 1)[0]
-            values[name]['CNAME'].append(target)
-
-        before = len([r for r in values.values()])
-        for name, types in values.items():
-            for _type, records in types.items():
-                data_for = getattr(self, f'_data_for_{_type}')
-                record = Record.new(
-                    zone,
-                    name,
-                    data_for(_type, records),
-                    source=self,
-                    lenient=lenient,
+        with self._prefetch_lock:
+            if zone.name in self.prefetch_zones:
+                zones, self.prefetch_zones = self.prefetch_zones, set()
+                self.prefetch(zones, self.prefetch_processes)
+
+        with self.instrumentation.phase('populate', zone.name):
+            try:
+                records = self._prefetched.pop(zone.name)
+            except KeyError:
+                # Pi-hole does not really have the concept of zones, the
+                # index only returns "records" within the zone with names
+                # relative to it
+                records = self._record_data(
+                    zone.name, self._client.zone_records(zone.name)
                 )
+
+            before = len(zone.records)
+            types = Record.registered_types()
+            for name, data, valid in records:
+                if valid:
+                    # validated already, skip straight to creating it
+                    record = types[data['type']](zone, name, data, source=self)
+                else:
+                    # let Record.new raise or warn about it
+                    record = Record.new(
+                        zone, name, data, source=self, lenient=lenient
+                    )
                 zone.add_record(record, lenient=lenient)
 
-        exists = len(values) > 0
-        self.log.info(
-            'populate:   found %s records, exists=%s',
-            len(zone.records) - before,
-            exists,
-        )
-        return exists
+            exists = len(records) > 0
+            self.log.info(
+                'populate:   found %s records, exists=%s',
+                len(zone.records) - before,
+                exists,
+            )
+            return exists
+
+    def drift(self, desired):
+        """Returns the changes planning desired would make as sorted (change
+        class name, fqdn, type) tuples, empty when there are none
+
+        A cheap drift check, e.g. for monitoring, comparing desired's A, AAAA
+        and CNAME values as (fqdn, type, value) sets to Pi-hole's entries
+        straight from the zone index, without creating records for them. As
+        with plan records ignored, excluded or not included for this provider
+        are skipped and those it doesn't support warned about, or refused
+        with strict_supports.
+        """
+
+        def encode(name):
+            try:
+                return idna_encode(name)
+            except IdnaError:
+                # populate would refuse it, it can't match anything desired
+                return name
+
+        zone_name = desired.name
+        with self.instrumentation.phase('drift', zone_name):
+            existing = set()
+            for name, a, aaaa, targets in self._client.zone_records(zone_name):
+                name = encode(name)
+                fqdn = f'{name}.{zone_name}' if name else zone_name
+                existing.update((fqdn, 'A', ip) for ip in a)
+                # normalized as octoDNS does, inet_ntop can differ
+                existing.update(
+                    (fqdn, 'AAAA', str(ip_address(ip))) for ip in aaaa
+                )
+                if targets:
+                    # only the first is a record, see _data_for_CNAME
+                    existing.add((fqdn, 'CNAME', encode(targets[0])))
+
+            wanted = set()
+            # (fqdn, type) plan wouldn't touch
+            skipped = set()
+            for record in desired.records:
+                key = (record.fqdn, record._type)
+                if (
+                    record.ignored
+                    or self.id in record.excluded
+                    or (record.included and self.id not in record.included)
+                ):
+                    skipped.add(key)
+                    continue
+                if not self.supports(record):
+                    self.supports_warn_or_except(
+                        f'{record._type} records not supported for '
+                        f'{record.fqdn}',
+                        'omitting record',
+                    )
+                    continue
+                if hasattr(record, 'values'):
+                    values = record.values
+                else:
+                    values = (record.value,)
+                wanted.update((*key, value) for value in values)
+
+            existing_keys = {(fqdn, _type) for fqdn, _type, _ in existing}
+            wanted_keys = {(fqdn, _type) for fqdn, _type, _ in wanted}
+            changes = []
+            for key in {k[:2] for k in existing ^ wanted} - skipped:
+                if key not in wanted_keys:
+                    changes.append(('Delete', *key))
+                elif key not in existing_keys:
+                    changes.append(('Create', *key))
+                else:
+                    changes.append(('Update', *key))
+
+        self.log.info('drift: zone=%s, changes=%d', zone_name, len(changes))
+        return sorted(changes)
 
     def _params_for_multiple(self, record):
         for value in record.values:
@@ -297,8 +1944,31 @@ class PiholeProvider(BaseProvider):
                     )
 
     def _apply_Update(self, change):
-        self._apply_Delete(change)
-        self._apply_Create(change)
+        existing = change.existing
+        new = change.new
+        match change.record._type:
+            case 'A' | 'AAAA':
+                # Only the values that changed, the others keep their place
+                # in Pi-hole's list
+                before = {
+                    p['data']: p['name']
+                    for p in self._params_for_multiple(existing)
+                }
+                after = {
+                    p['data']: p['name'] for p in self._params_for_multiple(new)
+                }
+                for ip, name in before.items():
+                    if ip not in after:
+                        self._client.delete_host_record(ip, name)
+                for ip, name in after.items():
+                    if ip not in before:
+                        self._client.add_host_record(ip, name)
+            case _:  # CNAME
+                # swapped in place, keeping its position in Pi-hole's list
+                (params,) = self._params_for_single(new)
+                self._client.replace_cname_record(
+                    params['name'], existing.value, new.value
+                )
 
     def _apply_Delete(self, change):
         existing = change.existing
@@ -316,6 +1986,13 @@ class PiholeProvider(BaseProvider):
                         params['name'], params['data']
                     )
 
+    def _batch_full(self):
+        max_changes = self.batch_max_changes
+        if max_changes is not None and self._client.pending >= max_changes:
+            return True
+        max_age = self.batch_max_age
+        return max_age is not None and self._client.pending_age >= max_age
+
     def _apply(self, plan):
         desired = plan.desired
         changes = plan.changes
@@ -323,10 +2000,23 @@ class PiholeProvider(BaseProvider):
             '_apply: zone=%s, len(changes)=%d', desired.name, len(changes)
         )
 
-        for change in changes:
-            class_name = change.__class__.__name__
-            getattr(self, f'_apply_{class_name}')(change)
+        # changes are about to make them stale
+        self._prefetched.clear()
+
+        with self.instrumentation.phase('_apply', desired.name):
+            for change in changes:
+                class_name = change.__class__.__name__
+                getattr(self, f'_apply_{class_name}')(change)
+
+            if self.batch_apply and not self._batch_full():
+                self.log.info(
+                    '_apply: deferring %d pending changes', self._client.pending
+                )
+                return
+
+            self.log.info('_apply: sending changes to Pi-hole')
+
+            self._client.apply()
 
-        self.log.info('_apply: sending changes to Pi-hole')
 
-        self._client.apply()
+atexit.register(PiholeProvider._at_exit)
@@ -0,0 +1,401 @@
+#
+#
+#
+
+import asyncio
+from json import dumps, loads
+from random import uniform
+from threading import Lock, Thread
+from time import monotonic, perf_counter
+
+from aiohttp import (
+    ClientConnectorError,
+    ClientResponseError,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+)
+
+from octodns import __VERSION__ as octodns_version
+
+from . import (
+    __VERSION__,
+    Instrumentation,
+    PiholeClient,
+    PiholeClientException,
+    PiholeClientNotFound,
+    PiholeClientUnauthorized,
+)
+
+
+class AsyncPiholeClient(object):
+    """asyncio native Pi-hole API client
+
+    Mirrors PiholeClient's session handling, a single login reused until
+    shortly before it expires and retried once on 401, timeouts and retry
+    policy over a pooled aiohttp session. At most max_connections requests
+    are in flight at once, further ones wait their turn. Requests are
+    reported to instrumentation, see Instrumentation.
+    """
+
+    SESSION_REFRESH_MARGIN = PiholeClient.SESSION_REFRESH_MARGIN
+    DEFAULT_CONNECT_TIMEOUT = PiholeClient.DEFAULT_CONNECT_TIMEOUT
+    DEFAULT_READ_TIMEOUT = PiholeClient.DEFAULT_READ_TIMEOUT
+    RETRY_METHODS = PiholeClient.RETRY_METHODS
+    RETRY_STATUSES = PiholeClient.RETRY_STATUSES
+
+    def __init__(
+        self,
+        url,
+        password,
+        totp=None,
+        tls_verify=True,
+        timeout=None,
+        connect_timeout=None,
+        read_timeout=None,
+        retries=3,
+        backoff_factor=0.5,
+        max_connections=8,
+        instrumentation=None,
+    ):
+        self.instrumentation = instrumentation or Instrumentation()
+        self._password = password
+        self._tls_verify = tls_verify
+        self._totp = totp
+        self._url = url
+        self.backoff_factor = backoff_factor
+        self.max_connections = max_connections
+        self.retries = retries
+        self.timeout = ClientTimeout(
+            sock_connect=connect_timeout
+            or timeout
+            or self.DEFAULT_CONNECT_TIMEOUT,
+            sock_read=read_timeout or timeout or self.DEFAULT_READ_TIMEOUT,
+        )
+
+        # created on first use as they must belong to the running loop
+        self._http = None
+        self._auth_lock = None
+        self._limit = None
+
+        self._sid = None
+        self._session_expires = 0
+        self.login_count = 0
+
+    def _session(self):
+        if self._http is None:
+            self._http = ClientSession(
+                connector=TCPConnector(
+                    limit=self.max_connections,
+                    ssl=None if self._tls_verify else False,
+                ),
+                headers={
+                    'accept': 'application/json',
+                    'User-Agent': f'octodns/{octodns_version} octodns-pihole/{__VERSION__}',
+                },
+                timeout=self.timeout,
+            )
+            self._auth_lock = asyncio.Lock()
+            self._limit = asyncio.Semaphore(self.max_connections)
+        return self._http
+
+    @property
+    def authorized(self):
+        return self._sid is not None and monotonic() < self._session_expires
+
+    async def authorize(self):
+        self._session()
+        async with self._auth_lock:
+            # another task may have logged in while we waited
+            if self.authorized:
+                return
+
+            data = await self._request(
+                'POST',
+                '/api/auth',
+                data={"password": self._password, "totp": self._totp},
+                auth_required=False,
+            )
+            try:
+                sid = data["session"]["sid"]
+                validity = data["session"]["validity"]
+            except (KeyError, TypeError):
+                raise PiholeClientException('Unexpected authorization response')
+
+            self._sid = sid
+            self._session_expires = (
+                monotonic() + validity - self.SESSION_REFRESH_MARGIN
+            )
+            self.login_count += 1
+
+    async def _request(
+        self,
+        method,
+        path,
+        params=None,
+        data=None,
+        auth_required=True,
+        retry_unauthorized=True,
+    ):
+        """Makes a request returning its decoded JSON body, if any"""
+        http = self._session()
+        if auth_required and not self.authorized:
+            await self.authorize()
+
+        headers = {'sid': self._sid} if self._sid else {}
+        idempotent = method in self.RETRY_METHODS
+        attempt = 0
+        start = perf_counter()
+        while True:
+            try:
+                async with self._limit:
+                    async with http.request(
+                        method,
+                        f'{self._url}{path}',
+                        params=params,
+                        json=data,
+                        headers=headers,
+                    ) as resp:
+                        status = resp.status
+                        body = await resp.read()
+                retry = idempotent and status in self.RETRY_STATUSES
+            except ClientConnectorError:
+                # never connected so safe to retry regardless of method
+                if attempt >= self.retries:
+                    raise
+                retry = True
+
+            if not retry or attempt >= self.retries:
+                break
+            attempt += 1
+            await asyncio.sleep(self._backoff(attempt))
+
+        self.instrumentation.request(
+            self._url,
+            method,
+            path,
+            status,
+            perf_counter() - start,
+            len(dumps(data)) if data is not None else 0,
+            len(body),
+            attempt,
+        )
+
+        if status >= 400 and status not in (401, 404):
+            raise ClientResponseError(
+                resp.request_info,
+                resp.history,
+                status=status,
+                message=resp.reason,
+            )
+
+        match status:
+            case 401 if auth_required and retry_unauthorized:
+                # The session was expired or revoked server side, log in
+                # again and give the request one more try
+                self._sid = None
+                return await self._request(
+                    method,
+                    path,
+                    params=params,
+                    data=data,
+                    retry_unauthorized=False,
+                )
+            case 401:
+                raise PiholeClientUnauthorized()
+            case 404:
+                raise PiholeClientNotFound()
+
+        return loads(body) if body else None
+
+    def _backoff(self, attempt):
+        # exponential with jitter, as urllib3 does for PiholeClient
+        factor = self.backoff_factor
+        return factor * 2 ** (attempt - 1) + uniform(0, factor)
+
+    async def fetch_dns(self):
+        """Returns the (hosts, cnameRecords) lists of Pi-hole's DNS config"""
+        resp = await self._request('GET', '/api/config/dns')
+        try:
+            dns = resp["config"]["dns"]
+            return dns["hosts"], dns["cnameRecords"]
+        except (KeyError, TypeError):
+            raise PiholeClientException(
+                'Unexpected response gathering DNS config'
+            )
+
+    async def get_cname_records(self):
+        _, cnames = await self.fetch_dns()
+        return cnames
+
+    async def get_host_records(self):
+        hosts, _ = await self.fetch_dns()
+        return hosts
+
+    async def apply(self, dns):
+        """Replaces Pi-hole's lists with the ones in dns"""
+        await self._request(
+            'PATCH', '/api/config', data={"config": {"dns": dns}}
+        )
+
+    async def logout(self):
+        """Ends the current session, if any, freeing its Pi-hole slot"""
+        if self._sid is None:
+            return
+
+        try:
+            await self._request('DELETE', '/api/auth', auth_required=False)
+        except PiholeClientUnauthorized:
+            # already expired or revoked
+            pass
+        finally:
+            self._sid = None
+            self._session_expires = 0
+
+    async def close(self):
+        """Logs out and closes the connection pool"""
+        try:
+            await self.logout()
+        finally:
+            if self._http is not None:
+                await self._http.close()
+                self._http = None
+
+
+class EventLoopThread(object):
+    """An asyncio event loop running in a daemon thread
+
+    Lets synchronous code, e.g. PiholeProvider, drive coroutines with run.
+    Everything sharing a loop shares its thread and can overlap.
+    """
+
+    _shared = None
+    _shared_lock = Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(
+            target=self.loop.run_forever, name='octodns-pihole', daemon=True
+        )
+        self._thread.start()
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def run(self, coro):
+        """Runs coro on the loop, blocking until it is done"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+class AioPiholeClient(PiholeClient):
+    """PiholeClient making its requests with an AsyncPiholeClient
+
+    Requests run on a shared EventLoopThread so all of the clients in a
+    process, e.g. the members of a PiholeFleet, overlap on one loop.
+    """
+
+    class _Response(object):
+        def __init__(self, body):
+            self._body = body
+
+        def json(self):
+            return self._body
+
+    def __init__(
+        self,
+        url,
+        password,
+        totp=None,
+        tls_verify=True,
+        snapshot_ttl=300,
+        cache_dir=None,
+        cache_ttl=300,
+        stream=False,
+        stream_zones=(),
+        update_mode='auto',
+        merge=False,
+        merge_attempts=3,
+        instrumentation=None,
+        compress=False,
+        max_patch_size=None,
+        loop=None,
+        **kwargs,
+    ):
+        super().__init__(
+            url,
+            password,
+            totp=totp,
+            tls_verify=tls_verify,
+            snapshot_ttl=snapshot_ttl,
+            cache_dir=cache_dir,
+            cache_ttl=cache_ttl,
+            stream=stream,
+            stream_zones=stream_zones,
+            update_mode=update_mode,
+            merge=merge,
+            merge_attempts=merge_attempts,
+            instrumentation=instrumentation,
+            compress=compress,
+            max_patch_size=max_patch_size,
+            **kwargs,
+        )
+        self._aio = AsyncPiholeClient(
+            url,
+            password,
+            totp=totp,
+            tls_verify=tls_verify,
+            instrumentation=self.instrumentation,
+            **kwargs,
+        )
+        self._loop = loop or EventLoopThread.shared()
+
+    def _run(self, coro):
+        try:
+            return self._loop.run(coro)
+        except ClientResponseError as e:
+            raise PiholeClientException(f'{e.status} {e.message}') from e
+        finally:
+            self.login_count = self._aio.login_count
+
+    @property
+    def authorized(self):
+        return self._aio.authorized
+
+    def _authorize(self):
+        self._run(self._aio.authorize())
+
+    def _request(
+        self, method, path, params=None, data=None, auth_required=True
+    ):
+        return self._Response(
+            self._run(
+                self._aio._request(
+                    method,
+                    path,
+                    params=params,
+                    data=data,
+                    auth_required=auth_required,
+                )
+            )
+        )
+
+    def _patch(self, body):
+        # aiohttp encodes the body whole, uncompressed
+        self._request(
+            'PATCH', '/api/config', data={'config': {'dns': body.dns}}
+        )
+
+    def _stream_snapshot(self):
+        # aiohttp's body is read whole, only the index is kept small
+        hosts, cnames = self._run(self._aio.fetch_dns())
+        for entry in hosts:
+            yield 'hosts', entry
+        for entry in cnames:
+            yield 'cnameRecords', entry
+
+    def logout(self):
+        self._run(self._aio.close())
@@ -0,0 +1,235 @@
+#
+#
+#
+
+import logging
+import re
+from argparse import ArgumentParser
+from json import dumps
+from os import environ, makedirs, replace
+from os.path import join
+from socket import AF_INET, AF_INET6, inet_ntop, inet_pton
+from time import perf_counter
+
+from . import PiholeClient
+
+log = logging.getLogger('PiholeExport')
+
+_DIGITS = re.compile(r'(\d+)')
+
+# scalars that YAML reads back as the same string when left unquoted
+_PLAIN = re.compile(r'[A-Za-z_][\w.-]*|\d+\.\d+\.\d+\.\d+')
+# unless they are one of YAML 1.1's booleans or null
+_RESERVED = {'y', 'yes', 'n', 'no', 'true', 'false', 'on', 'off', 'null'}
+
+
+def _scalar(value):
+    if not value:
+        return "''"
+    if _PLAIN.fullmatch(value) and value.lower() not in _RESERVED:
+        return value
+    # JSON strings are valid YAML
+    return dumps(value)
+
+
+def _natural_key(value):
+    # The order octoDNS's YAML loader enforces, natsort's default, without
+    # the generality that makes natsort's own key the slowest part of export
+    parts = _DIGITS.split(value)
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+
+def _apex(name, zones, depth):
+    """Returns the zone name belongs to, None when it is in none of zones"""
+    labels = name.split('.')
+    if zones:
+        # the longest of zones name is within
+        for i in range(len(labels)):
+            zone = '.'.join(labels[i:])
+            if zone in zones:
+                return zone
+        return None
+    # trailing dot, the last label is empty
+    return '.'.join(labels[-depth - 1 :])
+
+
+def _fqdn(name):
+    # entries added through Pi-hole's UI have no trailing dot
+    return name.lower().rstrip('.') + '.'
+
+
+def _address(ip):
+    """Returns ip in canonical form, None when it is invalid"""
+    family = AF_INET6 if ':' in ip else AF_INET
+    try:
+        return inet_ntop(family, inet_pton(family, ip))
+    except OSError:
+        return None
+
+
+def _record(_type, values, indent):
+    if _type == 'CNAME' or len(values) == 1:
+        # as populate, only a CNAME's first target is a record
+        value = f'value: {_scalar(values[0])}'
+    else:
+        value = 'values:' + ''.join(f'\n{indent}- {_scalar(v)}' for v in values)
+    return f'type: {_type}\n{indent}{value}\n'
+
+
+def _write_zone(directory, zone, names):
+    """Writes zone's names, {name: [a, aaaa, targets]}, as octoDNS YAML"""
+    path = join(directory, f'{zone}yaml')
+    tmp = f'{path}.tmp'
+    records = 0
+    with open(tmp, 'w') as fh:
+        fh.write('---\n')
+        for name in sorted(names, key=_natural_key):
+            a, aaaa, targets = names[name]
+            if targets and (a or aaaa):
+                log.warning(
+                    'CNAME %s%s has other records, octoDNS will refuse it',
+                    f'{name}.' if name else '',
+                    zone,
+                )
+            data = [
+                (_type, values)
+                for _type, values in (
+                    ('A', a),
+                    ('AAAA', aaaa),
+                    ('CNAME', targets),
+                )
+                if values
+            ]
+            records += len(data)
+            fh.write(f'{_scalar(name)}:\n')
+            if len(data) == 1:
+                fh.write(f'  {_record(*data[0], "  ")}')
+            else:
+                fh.writelines(f'  - {_record(*d, "    ")}' for d in data)
+    replace(tmp, path)
+    return records
+
+
+def export(client, directory, zones=(), depth=1):
+    """Writes Pi-hole's local DNS records out as octoDNS YAML, one file per
+    zone in directory, returning what was exported
+
+    The lists are fetched once and each entry filed under its zone in a
+    single pass, the longest of zones it is within or, without zones, its
+    last depth labels. Names and targets lacking one get a trailing dot.
+    Zones are then written one at a time, straight from the entries, without
+    creating octoDNS records. Invalid hosts entries and those outside of
+    zones are skipped.
+    """
+    start = perf_counter()
+    hosts, cnames = client.snapshot()
+    fetched = perf_counter() - start
+
+    zones = {_fqdn(z) for z in zones}
+    # zone: {name relative to it: [a, aaaa, targets]}
+    grouped = {}
+    skipped = 0
+
+    def values(name):
+        name = _fqdn(name)
+        zone = _apex(name, zones, depth)
+        if zone is None:
+            return None
+        relative = name[: -len(zone) - 1] if name != zone else ''
+        names = grouped.setdefault(zone, {})
+        try:
+            return names[relative]
+        except KeyError:
+            ret = names[relative] = [[], [], []]
+            return ret
+
+    for entry in hosts:
+        ip, name = entry.split(' ', 1)
+        address = _address(ip)
+        if address is None:
+            log.warning('ignoring invalid hosts entry "%s"', entry)
+            skipped += 1
+            continue
+        record = values(name)
+        if record is None:
+            skipped += 1
+            continue
+        record[1 if ':' in address else 0].append(address)
+
+    for entry in cnames:
+        name, target = entry.split(',', 1)
+        record = values(name)
+        if record is None:
+            skipped += 1
+            continue
+        record[2].append(target if target.endswith('.') else f'{target}.')
+
+    makedirs(directory, exist_ok=True)
+    stats = {'entries': len(hosts) + len(cnames), 'skipped': skipped}
+    stats['zones'] = len(grouped)
+    stats['records'] = 0
+    for zone in sorted(grouped):
+        # done with once written
+        stats['records'] += _write_zone(directory, zone, grouped.pop(zone))
+
+    stats['fetch_seconds'] = fetched
+    stats['seconds'] = seconds = perf_counter() - start
+    log.info(
+        'export: %d entries, %d records in %d zones, in %.3fs (%.0f entries/s)',
+        stats['entries'],
+        stats['records'],
+        stats['zones'],
+        seconds,
+        stats['entries'] / seconds,
+    )
+    return stats
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description="Dumps Pi-hole's local DNS records as octoDNS YAML"
+    )
+    parser.add_argument('url', help='Pi-hole to export, e.g. https://pi.hole')
+    parser.add_argument('directory', help='Where to write the zone files')
+    parser.add_argument(
+        '--password',
+        default=environ.get('PIHOLE_PASSWORD'),
+        help='Defaults to $PIHOLE_PASSWORD',
+    )
+    parser.add_argument('--totp', help='Required when 2FA is enabled')
+    parser.add_argument(
+        '--no-tls-verify', action='store_true', help="Skip TLS verification"
+    )
+    parser.add_argument(
+        '--zone',
+        action='append',
+        default=[],
+        help='Zone to export, may be repeated, by default every name is filed '
+        'under its last --depth labels',
+    )
+    parser.add_argument(
+        '--depth',
+        type=int,
+        default=1,
+        help='Labels making up a discovered zone, 1 for lan., 2 for '
+        'example.tld.',
+    )
+    args = parser.parse_args(argv)
+
+    client = PiholeClient(
+        args.url,
+        args.password,
+        totp=args.totp,
+        tls_verify=not args.no_tls_verify,
+    )
+    try:
+        stats = export(client, args.directory, args.zone, args.depth)
+    finally:
+        client.logout()
+    print(
+        f'{stats["entries"]} entries, {stats["records"]} records in '
+        f'{stats["zones"]} zones, {stats["skipped"]} skipped, in '
+        f'{stats["seconds"]:.3f}s '
+        f'({stats["entries"] / stats["seconds"]:.0f} entries/s)'
+    )
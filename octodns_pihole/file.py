@@ -0,0 +1,146 @@
+#
+#
+#
+
+import re
+from json import dump, dumps, load
+from os import replace
+
+from . import PiholeClient, PiholeClientException
+
+# a table's header, e.g. [dns], on a line of its own
+_TOML_TABLE = re.compile(r'^[ \t]*\[([^\[\]\n]+)\][ \t]*(#.*)?$', re.M)
+
+
+def _toml_array_end(text, pos):
+    """Returns the index just past the array starting at pos"""
+    depth = 0
+    i = pos
+    while i < len(text):
+        c = text[i]
+        if c == '#':
+            i = text.find('\n', i)
+            if i == -1:
+                break
+        elif c in '"\'':
+            # basic strings have escapes, literal ones don't
+            j = i + 1
+            while j < len(text) and text[j] != c:
+                j += 2 if c == '"' and text[j] == '\\' else 1
+            i = j
+        elif c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+            if not depth:
+                return i + 1
+        i += 1
+    raise PiholeClientException('Unterminated array in pihole.toml')
+
+
+def _toml_array(entries):
+    # JSON strings are valid TOML basic strings
+    items = ''.join(f'    {dumps(e)},\n' for e in entries)
+    return f'[\n{items}  ]' if entries else '[]'
+
+
+def _toml_table(text, table):
+    """Returns the span of table's body in text"""
+    for header in _TOML_TABLE.finditer(text):
+        if header.group(1).strip() == table:
+            following = _TOML_TABLE.search(text, header.end())
+            end = following.start() if following else len(text)
+            return header.end(), end
+    raise PiholeClientException(f'No [{table}] table in pihole.toml')
+
+
+def toml_replace(text, table, values):
+    """Returns text, a TOML document, with the arrays of table's keys
+    replaced by values' lists, everything else is left as it is"""
+    for key, entries in values.items():
+        start, end = _toml_table(text, table)
+        array = _toml_array(entries)
+        match = re.compile(rf'^[ \t]*{key}[ \t]*=[ \t]*', re.M).search(
+            text, start, end
+        )
+        if match:
+            stop = _toml_array_end(text, match.end())
+            text = text[: match.end()] + array + text[stop:]
+        else:
+            # Pi-hole writes every key, add it should it be missing
+            text = f'{text[:start]}\n  {key} = {array}{text[start:]}'
+    return text
+
+
+class PiholeFileClient(PiholeClient):
+    """PiholeClient backed by a local copy of Pi-hole's DNS config
+
+    url is the path, optionally as a file:// URL, of either Pi-hole's own
+    pihole.toml, when it ends in .toml, or a JSON export shaped like the
+    response of GET /api/config/dns. Snapshots are read from it and updates
+    written back to it, replacing only the hosts and cnameRecords lists, so
+    planning and applying need no Pi-hole at all, e.g. in CI, to compute
+    changes ahead of a maintenance window or to profile the provider
+    without HTTP. Changes are always written whole.
+    """
+
+    def __init__(self, url, password=None, **kwargs):
+        # nothing to gain from per entry writes or compression
+        kwargs.update(update_mode='patch', max_patch_size=None, compress=False)
+        super().__init__(url, password, **kwargs)
+        self.path = url.removeprefix('file://')
+        self.toml = self.path.endswith('.toml')
+        if self.toml:
+            try:
+                from tomllib import load as toml_load
+            except ImportError:
+                raise PiholeClientException(
+                    'Reading pihole.toml needs Python 3.11'
+                )
+            self._toml_load = toml_load
+
+    @property
+    def authorized(self):
+        # there's no session to log in to
+        return True
+
+    def _fetch_snapshot(self):
+        try:
+            if self.toml:
+                with open(self.path, 'rb') as fh:
+                    dns = self._toml_load(fh)['dns']
+            else:
+                with open(self.path) as fh:
+                    dns = load(fh)['config']['dns']
+            return dns['hosts'], dns['cnameRecords']
+        except OSError as e:
+            raise PiholeClientException(f'Unable to read {self.path}: {e}')
+        except (KeyError, TypeError, ValueError):
+            raise PiholeClientException(f'Unexpected DNS config in {self.path}')
+
+    def _stream_snapshot(self):
+        # read whole, only the index is kept small
+        hosts, cnames = self._fetch_snapshot()
+        for entry in hosts:
+            yield 'hosts', entry
+        for entry in cnames:
+            yield 'cnameRecords', entry
+
+    def _patch(self, body):
+        tmp = f'{self.path}.tmp'
+        if self.toml:
+            with open(self.path) as fh:
+                text = toml_replace(fh.read(), 'dns', body.dns)
+            with open(tmp, 'w') as fh:
+                fh.write(text)
+        else:
+            with open(self.path) as fh:
+                data = load(fh)
+            data['config']['dns'].update(body.dns)
+            with open(tmp, 'w') as fh:
+                dump(data, fh, indent=2)
+        # never leaves a partial file behind
+        replace(tmp, self.path)
+
+    def logout(self):
+        pass
@@ -0,0 +1,243 @@
+#
+#
+#
+
+import logging
+from hashlib import sha256
+from os import walk
+from os.path import join
+from threading import Event
+from time import perf_counter
+
+from octodns.cmds.args import ArgumentParser
+from octodns.manager import Manager
+from octodns.provider import ProviderException
+from octodns.provider.yaml import YamlProvider
+
+from . import PiholeProvider, content_hash
+
+
+class Reconciler(object):
+    """Keeps Pi-hole in line with an octoDNS config
+
+    A long running alternative to octodns-sync from cron. Each pass hashes
+    the config file and the files of its YAML sources and fetches Pi-hole's
+    DNS config over the PiholeProviders' sessions, which are kept from one
+    pass to the next. octoDNS's sync only runs when either differs from
+    what was last synced, otherwise the pass is skipped. Changes to other
+    kinds of sources can't be seen, max_skips forces a sync after that many
+    skipped passes in a row.
+
+    Passes are counted in stats and the time spent polling and syncing is
+    totalled in timings as [count, seconds, slowest].
+    """
+
+    def __init__(
+        self,
+        config_file,
+        interval=60,
+        dry_run=True,
+        force=False,
+        eligible_zones=(),
+        max_skips=None,
+    ):
+        self.log = logging.getLogger('PiholeReconciler')
+        self.config_file = config_file
+        self.dry_run = dry_run
+        self.eligible_zones = list(eligible_zones)
+        self.force = force
+        self.interval = interval
+        self.max_skips = max_skips
+        self.stats = {'passes': 0, 'skipped': 0, 'synced': 0, 'failed': 0}
+        self.timings = {'poll': [0, 0, 0], 'sync': [0, 0, 0]}
+
+        self._config_hash = None
+        self._manager = None
+        # skipped passes since the last sync
+        self._skips = 0
+        self._stop = Event()
+        # (source hash, remote hash) as of the last sync
+        self._synced = None
+
+    @property
+    def providers(self):
+        return [
+            p
+            for p in self._manager.providers.values()
+            if isinstance(p, PiholeProvider)
+        ]
+
+    def _timed(self, name, func):
+        start = perf_counter()
+        try:
+            return func()
+        finally:
+            seconds = perf_counter() - start
+            timing = self.timings[name]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def _load(self):
+        """Returns the config file's hash, (re)loading it when it changed"""
+        with open(self.config_file, 'rb') as fh:
+            digest = sha256(fh.read()).hexdigest()
+        if digest != self._config_hash:
+            self.close()
+            self.log.info('_load: loading %s', self.config_file)
+            self._manager = Manager(self.config_file)
+            self._config_hash = digest
+            if not self.providers:
+                raise ProviderException(
+                    f'No PiholeProvider configured in {self.config_file}'
+                )
+        return digest
+
+    def _source_hash(self):
+        digest = sha256(self._load().encode())
+        for provider in self._manager.providers.values():
+            if not isinstance(provider, YamlProvider):
+                continue
+            for root, dirs, files in walk(provider.directory):
+                dirs.sort()
+                for name in sorted(files):
+                    path = join(root, name)
+                    digest.update(path.encode())
+                    with open(path, 'rb') as fh:
+                        digest.update(fh.read())
+        return digest.hexdigest()
+
+    def _remote_hash(self):
+        digest = sha256()
+        for provider in self.providers:
+            client = provider._client
+            if client.pending:
+                # deferred by batch_apply, send them rather than hash Pi-hole
+                # without them
+                client.apply()
+            # fresh, and then reused by the sync's populate
+            client.invalidate()
+            digest.update(content_hash(*client.snapshot()).encode())
+        return digest.hexdigest()
+
+    def _poll(self):
+        return self._source_hash(), self._remote_hash()
+
+    def _sync(self):
+        return self._manager.sync(
+            eligible_zones=self.eligible_zones,
+            dry_run=self.dry_run,
+            force=self.force,
+        )
+
+    def reconcile(self):
+        """Runs a single pass, returning whether it synced"""
+        self.stats['passes'] += 1
+        state = self._timed('poll', self._poll)
+        forced = self.max_skips is not None and self._skips >= self.max_skips
+        if state == self._synced and not forced:
+            self._skips += 1
+            self.stats['skipped'] += 1
+            self.log.debug('reconcile: no drift, skipping')
+            return False
+
+        self.log.info(
+            'reconcile: %s, syncing', 'forced' if forced else 'drifted'
+        )
+        changes = self._timed('sync', self._sync)
+        if changes and not self.dry_run:
+            # our own changes aren't drift
+            state = (state[0], self._remote_hash())
+        self._synced = state
+        self._skips = 0
+        self.stats['synced'] += 1
+        return True
+
+    def summary(self):
+        stats = ' '.join(f'{k}={v}' for k, v in self.stats.items())
+        timings = ' '.join(
+            f'{name}={seconds / (count or 1):.3f}s/{slowest:.3f}s'
+            for name, (count, seconds, slowest) in self.timings.items()
+        )
+        return f'{stats} {timings} (mean/slowest)'
+
+    def run(self, passes=None):
+        """Reconciles every interval seconds until stopped or passes have
+        run, a failed pass is logged and retried on the next"""
+        ran = 0
+        try:
+            while not self._stop.is_set():
+                start = perf_counter()
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    self.log.error('run: pass failed: %s', e)
+                ran += 1
+                if passes is not None and ran >= passes:
+                    break
+                self._stop.wait(max(self.interval - perf_counter() + start, 0))
+        finally:
+            self.log.info('run: %s', self.summary())
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        """Closes the PiholeProviders, sending any deferred changes"""
+        if self._manager is not None:
+            for provider in self.providers:
+                provider.close()
+            self._manager = None
+            self._config_hash = None
+
+
+def main():
+    parser = ArgumentParser(
+        description='Keeps Pi-hole in line with an octoDNS config'
+    )
+    parser.add_argument(
+        '--config-file',
+        required=True,
+        help='The Manager configuration file to use',
+    )
+    parser.add_argument(
+        '--doit',
+        action='store_true',
+        default=False,
+        help='Apply the changes, by default they are only planned',
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        default=False,
+        help='Acknowledge that significant changes are being made and do them',
+    )
+    parser.add_argument(
+        '--interval', type=float, default=60, help='Seconds between passes'
+    )
+    parser.add_argument(
+        '--max-skips',
+        type=int,
+        default=None,
+        help='Sync after this many passes in a row without drift',
+    )
+    parser.add_argument(
+        'zone', nargs='*', default=[], help='Limit to the specified zone(s)'
+    )
+    args = parser.parse_args()
+
+    reconciler = Reconciler(
+        args.config_file,
+        interval=args.interval,
+        dry_run=not args.doit,
+        force=args.force,
+        eligible_zones=args.zone,
+        max_skips=args.max_skips,
+    )
+    try:
+        reconciler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reconciler.close()
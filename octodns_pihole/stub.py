@@ -0,0 +1,256 @@
+#
+#
+#
+
+from argparse import ArgumentParser
+from gzip import decompress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from random import Random
+from threading import Lock, Thread
+from time import monotonic, sleep
+from urllib.parse import unquote
+
+
+class StubPihole(ThreadingHTTPServer):
+    """In-process stand-in for the parts of the Pi-hole v6 API we use
+
+    - POST/DELETE /api/auth, sessions expiring after validity seconds
+    - GET /api/config/dns and PATCH /api/config
+    - GET/PUT/DELETE /api/config/dns/{hosts,cnameRecords}[/{entry}]
+
+    Meant as a realistic target for tests and benchmarks. latency delays
+    every reply, errors is a queue of statuses replied with, in order,
+    before handling requests and error_rate the chance of any request
+    failing with a 503. Requests are recorded in log and the size of their
+    bodies, and of replies', counted in bytes_received and bytes_sent.
+    Compressed bodies are refused with a 415 unless gzip is set.
+    """
+
+    daemon_threads = True
+
+    LISTS = ('hosts', 'cnameRecords')
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, body=None):
+            data = dumps(body).encode() if body is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            with self.server.lock:
+                self.server.bytes_sent += len(data)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length', 0))
+            with self.server.lock:
+                self.server.bytes_received += length
+            data = self.rfile.read(length)
+            if self.headers.get('Content-Encoding') == 'gzip':
+                data = decompress(data)
+            return loads(data) if data else None
+
+        def _error(self, status, message):
+            self._reply(status, {'error': {'message': message}})
+
+        def _handle(self):
+            server = self.server
+            server.log.append((self.command, self.path))
+            if server.latency:
+                sleep(server.latency)
+
+            if self.path == '/api/auth':
+                return self._auth()
+
+            if not server.authorized(self.headers.get('sid')):
+                return self._reply(401, {})
+
+            status = server.injected_error()
+            if status:
+                return self._error(status, 'Injected error')
+
+            encoding = self.headers.get('Content-Encoding')
+            if encoding and not (encoding == 'gzip' and server.gzip):
+                return self._error(415, f'Unsupported encoding {encoding}')
+
+            path = self.path.removeprefix('/api/config').split('/', 3)[1:]
+            match (self.command, path):
+                case ('GET', ['dns']):
+                    return self._reply(200, {'config': {'dns': server.dns}})
+                case ('PATCH', []):
+                    dns = self._body()['config']['dns']
+                    with server.lock:
+                        server.dns.update(dns)
+                    return self._reply(200, {'config': {'dns': server.dns}})
+                case ('GET', ['dns', ('hosts' | 'cnameRecords') as key]):
+                    entries = server.dns[key]
+                    return self._reply(200, {'config': {'dns': {key: entries}}})
+                case (
+                    'PUT' | 'DELETE',
+                    ['dns', ('hosts' | 'cnameRecords') as key, entry],
+                ):
+                    return self._item(key, unquote(entry))
+            self._reply(server.status_override or 404, {})
+
+        def _auth(self):
+            server = self.server
+            if self.command == 'DELETE':
+                server.sids.pop(self.headers.get('sid'), None)
+                return self._reply(204)
+
+            if self._body()['password'] != server.password:
+                return self._reply(401, {'session': {'valid': False}})
+            with server.lock:
+                server.logins += 1
+                sid = f'sid-{server.logins}'
+                server.sids[sid] = monotonic() + server.validity
+            return self._reply(
+                200, {'session': {'sid': sid, 'validity': server.validity}}
+            )
+
+        def _item(self, key, entry):
+            server = self.server
+            with server.lock:
+                entries = server.dns[key]
+                match (self.command, entry in entries):
+                    case ('PUT', True):
+                        error = (400, 'Item already present')
+                    case ('PUT', False):
+                        error = entries.append(entry)
+                    case (_, False):
+                        error = (404, 'Item not found')
+                    case _:
+                        error = entries.remove(entry)
+            if error:
+                return self._error(*error)
+            self._reply(201 if self.command == 'PUT' else 204)
+
+        do_DELETE = do_GET = do_PATCH = do_POST = do_PUT = _handle
+
+    def __init__(
+        self,
+        password='password',
+        address=('127.0.0.1', 0),
+        latency=0,
+        error_rate=0,
+        validity=1800,
+        seed=None,
+        gzip=False,
+    ):
+        super().__init__(address, self.Handler)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.dns = {'cnameRecords': [], 'hosts': []}
+        self.error_rate = error_rate
+        # statuses to reply with, in order, before handling requests
+        self.errors = []
+        self.gzip = gzip
+        self.latency = latency
+        self.lock = Lock()
+        self.log = []
+        self.logins = 0
+        self.password = password
+        self._random = Random(seed)
+        # sid: when it expires
+        self.sids = {}
+        # status for requests nothing handles, 404 by default
+        self.status_override = None
+        self.validity = validity
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def authorized(self, sid):
+        expires = self.sids.get(sid)
+        return expires is not None and monotonic() < expires
+
+    def injected_error(self):
+        with self.lock:
+            if self.errors:
+                return self.errors.pop(0)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return 503
+        return None
+
+    def fill(self, hosts=0, cnames=0, zone='stub.tld.'):
+        """Adds generated entries, hosts alternating A and AAAA, and CNAMEs
+        pointing at them"""
+        for i in range(hosts):
+            if i % 2:
+                ip = f'2001:db8::{i >> 16:x}:{i & 0xffff:x}'
+            else:
+                ip = f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+            self.dns['hosts'].append(f'{ip} host-{i}.{zone}')
+        for i in range(cnames):
+            target = f'host-{i % hosts}.{zone}' if hosts else zone
+            self.dns['cnameRecords'].append(f'alias-{i}.{zone},{target}')
+        return self
+
+    def start(self):
+        """Serves requests from a background thread"""
+        self._thread = Thread(
+            target=self.serve_forever,
+            kwargs={'poll_interval': 0.01},
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Pi-hole API stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--password', default='password')
+    parser.add_argument(
+        '--hosts', type=int, default=0, help='Number of hosts entries'
+    )
+    parser.add_argument(
+        '--cnames', type=int, default=0, help='Number of CNAME entries'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0, help='Seconds to delay replies'
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0,
+        help='Fraction of requests failing with a 503',
+    )
+    parser.add_argument(
+        '--gzip', action='store_true', help='Accept gzip compressed bodies'
+    )
+    args = parser.parse_args(argv)
+
+    server = StubPihole(
+        args.password,
+        address=(args.host, args.port),
+        latency=args.latency,
+        error_rate=args.error_rate,
+        gzip=args.gzip,
+    )
+    server.fill(args.hosts, args.cnames)
+    print(f'Serving a Pi-hole stand-in on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
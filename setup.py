@@ -20,12 +20,26 @@ def version():
 
 description, long_description = descriptions()
 
-tests_require = ('pytest', 'pytest-cov', 'pytest-network', 'requests_mock')
+async_require = ('aiohttp>=3.9.0',)
+
+tests_require = (
+    'pytest',
+    'pytest-cov',
+    'pytest-network',
+    'requests_mock',
+) + async_require
 
 setup(
     author='Jonathan Voss',
     author_email='jvoss@onvox.net',
     description=description,
+    entry_points={
+        'console_scripts': (
+            'octodns-pihole-export = octodns_pihole.export:main',
+            'octodns-pihole-reconcile = octodns_pihole.reconcile:main',
+            'octodns-pihole-stub = octodns_pihole.stub:main',
+        )
+    },
     extras_require={
         'dev': tests_require
         + (
@@ -40,6 +54,7 @@ setup(
             'readme_renderer[md]>=26.0',
             'twine>=3.4.2',
         ),
+        'async': async_require,
         'test': tests_require,
     },
     install_requires=('octodns>=1.0.0', 'requests==2.32.3'),
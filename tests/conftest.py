@@ -1,9 +1,41 @@
+from json import loads
+
 import pytest
 from requests_mock import mock as requests_mock
 
+from octodns.record import Record
+from octodns.zone import Zone
+
+from octodns_pihole.stub import StubPihole
+
 MOCK_URL = 'http://pi-hole.mock'
 
 
+def sent_json(body):
+    """Decodes a PATCH body as it was sent, e.g. a PatchBody"""
+    return loads(b''.join(body))
+
+
+def fetches(mock):
+    """Number of times the DNS config was fetched, GETs sent to mock"""
+    return len([r for r in mock.request_history if r.method == 'GET'])
+
+
+def plan_zone(provider, zone, name, value):
+    """Plans zone with a single A record, name, of value"""
+    wanted = Zone(zone, [])
+    wanted.add_record(
+        Record.new(wanted, name, {'ttl': 300, 'type': 'A', 'value': value})
+    )
+    return provider.plan(wanted)
+
+
+@pytest.fixture
+def stub_pihole(enable_network):
+    with StubPihole() as server:
+        yield server
+
+
 @pytest.fixture
 def mock_request():
     with requests_mock() as mock:
@@ -23,5 +55,6 @@ def mock_request():
                 "took": 0.03569769859313965,
             },
         )
+        mock.delete(f"{MOCK_URL}/api/auth", status_code=204)
 
         yield mock
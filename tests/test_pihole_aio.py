@@ -0,0 +1,246 @@
+#
+#
+#
+
+import asyncio
+from sys import modules
+
+import pytest
+from aiohttp import ClientConnectorError, ClientResponseError
+from conftest import MOCK_URL
+
+from octodns.provider import ProviderException
+from octodns.record import Record
+from octodns.zone import Zone
+
+from octodns_pihole import (
+    PiholeClientException,
+    PiholeClientNotFound,
+    PiholeClientUnauthorized,
+    PiholeFleet,
+    PiholeProvider,
+)
+from octodns_pihole.aio import (
+    AioPiholeClient,
+    AsyncPiholeClient,
+    EventLoopThread,
+)
+
+
+class TestAsyncPiholeClient:
+    def test_client(self, stub_pihole):
+        stub_pihole.dns['hosts'] = ['1.1.1.1 a.unit.tests.']
+        stub_pihole.dns['cnameRecords'] = ['b.unit.tests.,a.unit.tests.']
+
+        async def run():
+            client = AsyncPiholeClient(
+                stub_pihole.url, 'password', max_connections=2
+            )
+
+            # concurrent requests share a single login
+            hosts, cnames = await asyncio.gather(
+                client.get_host_records(), client.get_cname_records()
+            )
+            assert ['1.1.1.1 a.unit.tests.'] == hosts
+            assert ['b.unit.tests.,a.unit.tests.'] == cnames
+            assert 1 == client.login_count
+
+            await client.apply({'hosts': []})
+            assert [] == stub_pihole.dns['hosts']
+            totals = client.instrumentation._requests
+            assert 2 == totals[('GET', '/api/config/dns')][0]
+            assert 1 == totals[('POST', '/api/auth')][0]
+            assert totals[('PATCH', '/api/config')][3] > 0
+
+            # a revoked session is renewed and the request retried
+            stub_pihole.sids.clear()
+            assert [] == await client.get_host_records()
+            assert 2 == client.login_count
+
+            # a missing endpoint
+            with pytest.raises(PiholeClientNotFound):
+                await client._request('GET', '/api/missing')
+
+            # other errors
+            stub_pihole.status_override = 500
+            with pytest.raises(Exception):
+                await client._request('GET', '/api/missing')
+
+            await client.close()
+            assert not stub_pihole.sids
+            # nothing to do once closed
+            await client.logout()
+            await client.close()
+
+        asyncio.run(run())
+
+    def test_errors(self, stub_pihole):
+        async def run():
+            # wrong password
+            client = AsyncPiholeClient(stub_pihole.url, 'wrong')
+            with pytest.raises(PiholeClientUnauthorized):
+                await client.get_host_records()
+            await client.close()
+
+            client = AsyncPiholeClient(stub_pihole.url, 'password')
+
+            # unexpected auth response
+            stub_pihole.password = None
+            orig = client._request
+
+            async def bad_auth(*args, **kwargs):
+                return {}
+
+            client._request = bad_auth
+            with pytest.raises(PiholeClientException) as ctx:
+                await client.authorize()
+            assert 'Unexpected authorization response' == str(ctx.value)
+            client._request = orig
+
+            # unexpected config response
+            client._sid = 'sid'
+            client._session_expires = float('inf')
+
+            async def bad_config(*args, **kwargs):
+                return {}
+
+            client._request = bad_config
+            with pytest.raises(PiholeClientException) as ctx:
+                await client.fetch_dns()
+            assert 'Unexpected response gathering DNS config' == str(ctx.value)
+            client._request = orig
+
+            # a rejected session is only retried once
+            with pytest.raises(PiholeClientUnauthorized):
+                await client._request(
+                    'GET', '/api/config/dns', retry_unauthorized=False
+                )
+
+            # session already gone on logout
+            async def unauthorized(*args, **kwargs):
+                raise PiholeClientUnauthorized()
+
+            client._sid = 'sid'
+            client._request = unauthorized
+            await client.close()
+            assert client._sid is None
+
+        asyncio.run(run())
+
+    def test_retries(self, stub_pihole):
+        async def run():
+            client = AsyncPiholeClient(
+                stub_pihole.url, 'password', backoff_factor=0
+            )
+            assert 10 == client.timeout.sock_connect
+            assert 120 == client.timeout.sock_read
+
+            # transient errors fetching are retried
+            stub_pihole.errors = [503, 502]
+            assert [] == await client.get_host_records()
+
+            # but updates are sent exactly once
+            stub_pihole.errors = [503]
+            with pytest.raises(ClientResponseError):
+                await client.apply({'hosts': []})
+            assert 1 == len(
+                [r for r in stub_pihole.log if r == ('PATCH', '/api/config')]
+            )
+
+            # and retrying gives up eventually
+            stub_pihole.errors = [503] * 4
+            with pytest.raises(ClientResponseError):
+                await client.get_host_records()
+            await client.close()
+
+            # failing to connect is retried, then raised
+            client = AsyncPiholeClient(
+                'http://127.0.0.1:1', 'password', retries=1, backoff_factor=0
+            )
+            with pytest.raises(ClientConnectorError):
+                await client.get_host_records()
+            await client.close()
+
+            assert 0.5 <= AsyncPiholeClient('', '')._backoff(1) <= 1
+
+        asyncio.run(run())
+
+
+class TestAioPiholeClient:
+    def test_shared_loop(self):
+        assert EventLoopThread.shared() is EventLoopThread.shared()
+
+    def test_provider(self, stub_pihole):
+        stub_pihole.dns['hosts'] = ['1.1.1.1 a.unit.tests.']
+
+        provider = PiholeProvider(
+            'test', stub_pihole.url, 'password', transport='aiohttp'
+        )
+        assert isinstance(provider._client, AioPiholeClient)
+        assert provider.instrumentation is (
+            provider._client._aio.instrumentation
+        )
+
+        wanted = Zone('unit.tests.', [])
+        wanted.add_record(
+            Record.new(
+                wanted, 'b', {'ttl': 60, 'type': 'A', 'value': '2.2.2.2'}
+            )
+        )
+        plan = provider.plan(wanted)
+        assert 2 == len(plan.changes)
+        provider.apply(plan)
+        assert ['2.2.2.2 b.unit.tests.'] == stub_pihole.dns['hosts']
+        assert 1 == provider._client.login_count
+        assert provider._client.authorized
+
+        provider.close()
+        assert not stub_pihole.sids
+
+        # errors from the async transport surface as client exceptions
+        client = AioPiholeClient(stub_pihole.url, 'password')
+        client._authorize()
+        assert client.authorized
+        stub_pihole.status_override = 500
+        with pytest.raises(PiholeClientException) as ctx:
+            client._request('GET', '/api/missing')
+        assert str(ctx.value).startswith('500')
+        client.logout()
+
+    def test_fleet(self, stub_pihole):
+        provider = PiholeProvider(
+            'test',
+            [stub_pihole.url, stub_pihole.url],
+            'password',
+            transport='aiohttp',
+        )
+        assert isinstance(provider._client, PiholeFleet)
+        assert all(
+            isinstance(c, AioPiholeClient) for c in provider._client.clients
+        )
+        provider.close()
+
+    def test_stream(self, stub_pihole):
+        stub_pihole.dns['hosts'] = ['1.1.1.1 a.unit.tests.', '2.2.2.2 other.']
+        stub_pihole.dns['cnameRecords'] = ['b.unit.tests.,a.unit.tests.']
+
+        client = AioPiholeClient(stub_pihole.url, 'password', stream=True)
+        assert [
+            ('b', [], [], ['a.unit.tests.']),
+            ('a', ['1.1.1.1'], [], []),
+        ] == list(client.zone_records('unit.tests.'))
+        assert client._snapshot is None
+        client.logout()
+
+    def test_transport(self, monkeypatch):
+        with pytest.raises(ProviderException) as ctx:
+            PiholeProvider('test', MOCK_URL, 'password', transport='carrier')
+        assert 'Unknown transport "carrier"' == str(ctx.value)
+
+        # aiohttp isn't installed
+        monkeypatch.setitem(modules, 'octodns_pihole.aio', None)
+        with pytest.raises(ProviderException) as ctx:
+            PiholeProvider('test', MOCK_URL, 'password', transport='aiohttp')
+        assert 'transport aiohttp requires octodns-pihole[async]' == str(
+            ctx.value
+        )
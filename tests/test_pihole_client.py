@@ -3,20 +3,306 @@
 #
 
 import json
-from unittest.mock import Mock, call
+from gzip import decompress
+from unittest.mock import Mock, call, patch
 
 import pytest
-from conftest import MOCK_URL
+from conftest import MOCK_URL, fetches, sent_json
+from requests import HTTPError
 from requests_mock import mock as requests_mock
 
 from octodns_pihole import (
+    AddressTable,
+    Instrumentation,
+    PatchBody,
     PiholeClient,
+    PiholeClientConflict,
     PiholeClientException,
     PiholeClientNotFound,
     PiholeClientUnauthorized,
+    RecordStore,
+    ZoneIndex,
+    iter_json_lists,
+    merge_conflicts,
+    merge_lists,
 )
 
 
+class TestRecordStore:
+    def test_store(self):
+        store = RecordStore(['b', 'a', 'b', 'c'])
+
+        # de-duplicates while keeping the original order
+        assert ['b', 'a', 'c'] == list(store)
+        assert 3 == len(store)
+        assert store == ['b', 'a', 'c']
+        assert "RecordStore(['b', 'a', 'c'])" == repr(store)
+
+        # adding an existing entry keeps its position
+        store.add('a')
+        assert ['b', 'a', 'c'] == list(store)
+
+        # new entries go to the end
+        store.add('d')
+        assert ['b', 'a', 'c', 'd'] == list(store)
+        assert 'd' in store
+
+        # discarding is a no-op for missing entries
+        store.discard('a')
+        store.discard('a')
+        assert ['b', 'c', 'd'] == list(store)
+        assert 'a' not in store
+
+    def test_replace(self):
+        store = RecordStore(['a', 'b', 'c'])
+
+        # takes the replaced entry's place
+        store.replace('b', 'x')
+        assert ['a', 'x', 'c'] == list(store)
+        assert 'b' not in store
+        assert 'x' in store
+
+        # goes to the end when there's nothing to replace
+        store.replace('b', 'y')
+        assert ['a', 'x', 'c', 'y'] == list(store)
+
+        # an entry that's already there keeps its position
+        store.replace('a', 'c')
+        assert ['x', 'c', 'y'] == list(store)
+
+    def test_compaction(self):
+        store = RecordStore(str(i) for i in range(10))
+        for i in range(8):
+            store.discard(str(i))
+        assert ['8', '9'] == list(store)
+        # holes don't outnumber entries
+        assert len(store._entries) <= 2 * len(store)
+        store.replace('8', '0')
+        assert ['0', '9'] == list(store)
+
+
+class TestIterJsonLists:
+    paths = {('config', 'dns', 'hosts'), ('config', 'dns', 'cnameRecords')}
+
+    def test_chunks(self):
+        doc = {
+            "config": {
+                "dns": {
+                    "upstreams": ["1.1.1.1"],
+                    "hosts": ["1.1.1.1 a.tld.", "2.2.2.2 \u00e9\\\"x."],
+                    # same key, other path
+                    "domain": {"name": "lan", "hosts": ["skipped"]},
+                    "other": [1, -2.5e3, True, None, {"hosts": ["skipped"]}],
+                    "cnameRecords": ["a.tld.,b.tld."],
+                }
+            },
+            "took": 0.1,
+        }
+        expected = [
+            (('config', 'dns', 'hosts'), '1.1.1.1 a.tld.'),
+            (('config', 'dns', 'hosts'), '2.2.2.2 \u00e9\\\"x.'),
+            (('config', 'dns', 'cnameRecords'), 'a.tld.,b.tld.'),
+        ]
+        for ensure_ascii in (True, False):
+            data = json.dumps(doc, ensure_ascii=ensure_ascii).encode()
+            # every chunk size splits tokens, escapes and characters somewhere
+            for size in range(1, len(data) + 1):
+                chunks = [data[i : i + size] for i in range(0, len(data), size)]
+                assert expected == list(iter_json_lists(chunks, self.paths))
+
+    def test_errors(self):
+        data = json.dumps(
+            {"config": {"dns": {"hosts": [], "cnameRecords": []}}}
+        ).encode()
+
+        with pytest.raises(ValueError, match='Truncated'):
+            list(iter_json_lists([data[:-1]], self.paths))
+        with pytest.raises(ValueError, match='Truncated'):
+            list(iter_json_lists([data[:-1] + b'"'], self.paths))
+        with pytest.raises(ValueError, match='Malformed'):
+            list(iter_json_lists([b'{}}'], self.paths))
+        with pytest.raises(ValueError, match='missing'):
+            list(iter_json_lists([b'{}'], self.paths))
+
+
+class TestPatchBody:
+    def test_chunks(self):
+        dns = {
+            'hosts': [f'10.0.0.{i} host-{i}.tld.' for i in range(100)],
+            'cnameRecords': ['\u00fc.tld.,host-0.tld.'],
+        }
+        body = PatchBody(dns, chunk_size=256)
+        chunks = list(body)
+        assert len(chunks) > 1
+        assert all(len(c) < 256 + 64 for c in chunks)
+        assert {'config': {'dns': dns}} == sent_json(chunks)
+        # its length is known without encoding it whole
+        assert len(b''.join(chunks)) == len(body)
+        # and it can be sent again, e.g. after logging in again
+        assert chunks == list(body)
+
+        assert {'config': {'dns': dns}} == json.loads(
+            decompress(body.compressed())
+        )
+        assert {'config': {'dns': {}}} == sent_json(PatchBody({}))
+
+
+class TestMerge:
+    def test_merge_lists(self):
+        # remote's order and changes are kept, ours applied on top
+        assert ['c', 'a', 'd', 'e'] == merge_lists(
+            ['c', 'a', 'b', 'd'], ['e', 'a'], ['b', 'gone']
+        )
+
+    def test_merge_conflicts(self):
+        hosts = ['1.1.1.1 a.tld.', '2.2.2.2 b.tld.']
+        cnames = ['c.tld.,a.tld.', 'c.tld.,b.tld.', 'b.tld.,a.tld.', 'd.,a.']
+        # two targets and hosts sharing a CNAME's name
+        assert ['b.tld.', 'c.tld.'] == merge_conflicts(
+            hosts, cnames, [], ['c.tld.,a.tld.', 'b.tld.,a.tld.', 'd.,a.']
+        )
+        # hosts added for a CNAME's name
+        assert ['b.tld.'] == merge_conflicts(
+            hosts, cnames, ['2.2.2.2 b.tld.', '1.1.1.1 a.tld.'], []
+        )
+        assert [] == merge_conflicts(hosts, [], hosts, [])
+
+
+class TestAddressTable:
+    def test_round_trip(self):
+        ips = [
+            '1.1.1.1',
+            '2001:db8::1',
+            # non-canonical and invalid addresses are kept verbatim
+            '2001:DB8:0::2',
+            'not-an-ip',
+            '10.0.0.1',
+        ]
+        table = AddressTable(ips)
+        assert len(ips) == len(table)
+        assert ips == [table.ip(i) for i in range(len(table))]
+        assert [4, 6, 6, 0, 4] == [table.version(i) for i in range(5)]
+
+
+class TestZoneIndex:
+    index = ZoneIndex(
+        [
+            '1.1.1.1 example.tld.',
+            '1.1.1.2 example.tld.',
+            '2.2.2.2 www.example.tld.',
+            '3.3.3.3 deep.sub.example.tld.',
+            '4.4.4.4 ample.tld.',
+            '5.5.5.5 no-dot.example.tld',
+            '2001:db8::1 example.tld.',
+            'not-an-ip bad.example.tld.',
+        ],
+        ['alias.example.tld.,www.example.tld.', 'alias.ample.tld.,ample.tld.'],
+    )
+
+    def test_records(self):
+        records = {
+            name: (a, aaaa, targets)
+            for name, a, aaaa, targets in self.index.records('example.tld.')
+        }
+        assert {
+            '': (['1.1.1.1', '1.1.1.2'], ['2001:db8::1'], []),
+            'www': (['2.2.2.2'], [], []),
+            'deep.sub': (['3.3.3.3'], [], []),
+            'alias': ([], [], ['www.example.tld.']),
+        } == records
+
+        # invalid addresses are left out of the tree
+        assert ['not-an-ip bad.example.tld.'] == self.index.invalid
+
+        # matches whole labels, not substrings
+        assert ['', 'alias'] == sorted(
+            name for name, _, _, _ in self.index.records('ample.tld.')
+        )
+
+        # sub-trees
+        assert [('deep', ['3.3.3.3'], [], [])] == list(
+            self.index.records('sub.example.tld.')
+        )
+
+        # unknown zones
+        assert [] == list(self.index.records('other.tld.'))
+        assert [] == list(self.index.records('missing.example.tld.'))
+
+    def test_zones(self):
+        index = ZoneIndex(
+            [
+                '1.1.1.1 example.tld.',
+                '2.2.2.2 www.example.tld.',
+                '3.3.3.3 other.tld.',
+                '4.4.4.4 www.other.tld.',
+                'not-an-ip www.other.tld.',
+            ],
+            ['alias.example.tld.,example.tld.', 'alias.other.tld.,other.tld.'],
+            zones={'example.tld.'},
+        )
+        assert {'', 'www', 'alias'} == {
+            name for name, _, _, _ in index.records('example.tld.')
+        }
+        # only the entries within zones are held
+        assert 2 == len(index.addresses)
+        assert [] == index.invalid
+        assert [] == list(index.records('other.tld.'))
+
+        assert index.covers('example.tld.')
+        assert index.covers('sub.example.tld.')
+        assert not index.covers('other.tld.')
+        assert not index.covers('ample.tld.')
+        assert ZoneIndex().covers('other.tld.')
+
+
+class TestInstrumentation:
+    def test_totals(self):
+        metrics = Mock()
+        instrumentation = Instrumentation(metrics)
+        assert instrumentation.summary() is None
+
+        # per entry calls are totalled by endpoint
+        path = '/api/config/dns/hosts/1.1.1.1%20a.unit.tests.'
+        instrumentation.request(MOCK_URL, 'PUT', path, 201, 0.5, 0, 10, 1)
+        path = '/api/config/dns/hosts/2.2.2.2%20b.unit.tests.'
+        instrumentation.request(MOCK_URL, 'PUT', path, 201, 0.25, 0, 10, 0)
+        key = ('PUT', '/api/config/dns/hosts')
+        assert [2, 0.75, 0.5, 0, 20, 1] == instrumentation._requests[key]
+        tags = {
+            'url': MOCK_URL,
+            'method': 'PUT',
+            'endpoint': '/api/config/dns/hosts',
+            'status': 201,
+        }
+        metrics.assert_any_call('request.seconds', 0.5, tags)
+        metrics.assert_any_call('request.sent', 0, tags)
+        metrics.assert_any_call('request.received', 10, tags)
+        metrics.assert_any_call('request.retries', 1, tags)
+
+        # phases are timed even when they fail
+        with pytest.raises(ValueError):
+            with instrumentation.phase('_apply', 'unit.tests.'):
+                raise ValueError('boom')
+        name, _, tags = metrics.call_args.args
+        assert 'phase.seconds' == name
+        assert {'phase': '_apply', 'zone': 'unit.tests.'} == tags
+        assert 1 == instrumentation._phases['_apply'][0]
+
+        summary = instrumentation.summary().split('\n')
+        assert 4 == len(summary)
+        assert summary[1].startswith('PUT /api/config/dns/hosts')
+        assert summary[2].startswith('phase')
+        assert summary[3].startswith('_apply')
+
+        # failing metrics are logged, never raised
+        metrics.side_effect = ValueError('unreachable')
+        with patch.object(instrumentation.log, 'warning') as warning:
+            instrumentation.request(
+                MOCK_URL, 'GET', '/api/config/dns', 200, 0.1, 0, 0, 0
+            )
+        assert 4 == warning.call_count
+
+
 class TestPiholeClient:
     client = PiholeClient(MOCK_URL, 'password')
 
@@ -38,6 +324,56 @@ class TestPiholeClient:
         # Successful auth
         self.client._authorize()
         assert 'sid' in self.client._session.headers
+        assert self.client.authorized
+
+    def test_session_reuse(self, mock_request):
+        client = PiholeClient(MOCK_URL, 'password')
+        client.snapshot_ttl = -1
+        empty = {"config": {"dns": {"cnameRecords": [], "hosts": []}}}
+        mock_request.get(f"{MOCK_URL}/api/config/dns", json=empty)
+
+        # logs in once and reuses the session
+        client.get_host_records()
+        client.get_host_records()
+        assert 1 == client.login_count
+
+        # refreshes the session once it is about to expire
+        client._session_expires = 0
+        assert not client.authorized
+        client.get_host_records()
+        assert 2 == client.login_count
+
+        # logs in again and retries once when the session was revoked
+        mock_request.get(
+            f"{MOCK_URL}/api/config/dns",
+            [{'status_code': 401}, {'json': empty}],
+        )
+        client.get_host_records()
+        assert 3 == client.login_count
+
+        # but does not retry forever
+        mock_request.get(f"{MOCK_URL}/api/config/dns", status_code=401)
+        with pytest.raises(PiholeClientUnauthorized):
+            client.get_host_records()
+        assert 4 == client.login_count
+
+    def test_logout(self, mock_request):
+        client = PiholeClient(MOCK_URL, 'password')
+
+        # nothing to do without a session
+        client.logout()
+        assert not mock_request.called
+
+        client._authorize()
+        client.logout()
+        assert 'sid' not in client._session.headers
+        assert 'DELETE' == mock_request.last_request.method
+
+        # an already expired session is fine
+        client._authorize()
+        mock_request.delete(f"{MOCK_URL}/api/auth", status_code=401)
+        client.logout()
+        assert not client.authorized
 
     def test_request(self):
         # test not found
@@ -54,109 +390,694 @@ class TestPiholeClient:
                     'GET', '/unauthorized', auth_required=False
                 )
 
+    def test_http_session(self):
+        client = PiholeClient(MOCK_URL, 'password')
+        assert (10, 120) == client.timeout
+
+        client = PiholeClient(MOCK_URL, 'password', timeout=5, read_timeout=60)
+        assert (5, 60) == client.timeout
+
+        client = PiholeClient(
+            MOCK_URL, 'password', retries=2, max_connections=4
+        )
+        adapter = client._session.get_adapter('https://pi-hole.lan')
+        assert 4 == adapter._pool_maxsize
+        retry = adapter.max_retries
+        assert 2 == retry.total
+        # updates and logins are never retried
+        assert 'GET' in retry.allowed_methods
+        assert 'PATCH' not in retry.allowed_methods
+        assert 'POST' not in retry.allowed_methods
+
+        # large responses are compressed
+        assert 'gzip' in client._session.headers['Accept-Encoding']
+
+    def test_retries(self, stub_pihole):
+        client = PiholeClient(stub_pihole.url, 'password', backoff_factor=0)
+
+        # transient errors fetching are retried
+        stub_pihole.errors = [503, 502]
+        assert [] == client.get_host_records()
+        assert 3 == len(
+            [r for r in stub_pihole.log if r == ('GET', '/api/config/dns')]
+        )
+
+        # but updates are sent exactly once
+        stub_pihole.errors = [503]
+        with pytest.raises(HTTPError) as ctx:
+            client.update({'hosts': []})
+        assert 503 == ctx.value.response.status_code
+        assert 1 == len(
+            [r for r in stub_pihole.log if r == ('PATCH', '/api/config')]
+        )
+
+        # and retrying gives up eventually
+        client.invalidate()
+        stub_pihole.errors = [503] * 4
+        with pytest.raises(HTTPError):
+            client.get_host_records()
+
+        client.logout()
+
+    def test_instrumentation(self, stub_pihole):
+        metrics = Mock()
+        client = PiholeClient(
+            stub_pihole.url,
+            'password',
+            backoff_factor=0,
+            instrumentation=Instrumentation(metrics),
+        )
+        stub_pihole.errors = [503]
+        client.get_host_records()
+        client.update({'hosts': ['1.1.1.1 a.unit.tests.']})
+
+        totals = client.instrumentation._requests
+        assert 1 == totals[('POST', '/api/auth')][0]
+        # the retried fetch is a single request
+        count, _, _, sent, received, retries = totals[
+            ('GET', '/api/config/dns')
+        ]
+        assert (1, 0, 1) == (count, sent, retries)
+        assert received > 0
+        assert totals[('PATCH', '/api/config')][3] > 0
+        metrics.assert_any_call(
+            'request.retries',
+            1,
+            {
+                'url': stub_pihole.url,
+                'method': 'GET',
+                'endpoint': '/api/config/dns',
+                'status': 200,
+            },
+        )
+        client.logout()
+
+    def test_patch(self, stub_pihole):
+        stub_pihole.fill(hosts=100)
+        hosts = list(stub_pihole.dns['hosts'])
+
+        # compressed where Pi-hole takes it
+        stub_pihole.gzip = True
+        client = PiholeClient(stub_pihole.url, 'password', compress=True)
+        client.update({'hosts': hosts[:50]})
+        assert hosts[:50] == stub_pihole.dns['hosts']
+        assert stub_pihole.bytes_received < len(PatchBody({'hosts': hosts}))
+
+        # otherwise sent as is from then on
+        stub_pihole.gzip = False
+        with patch.object(client.log, 'warning') as warning:
+            client.update({'hosts': hosts})
+        warning.assert_called_once()
+        assert not client.compress
+        assert hosts == stub_pihole.dns['hosts']
+
+        # other errors are just that
+        client.compress = True
+        stub_pihole.errors = [500]
+        with pytest.raises(HTTPError):
+            client.update({'hosts': hosts})
+        assert client.compress
+        client.logout()
+
+    def test_max_patch_size(self, stub_pihole):
+        stub_pihole.fill(hosts=10)
+        client = PiholeClient(
+            stub_pihole.url, 'password', update_mode='patch', max_patch_size=100
+        )
+        client.ITEM_CHUNK = 1
+        client.snapshot()
+
+        # too big a body is sent entry by entry, chunk by chunk
+        client.add_host_record('10.1.1.1', 'new.stub.tld.')
+        client.delete_host_record('10.0.0.0', 'host-0.stub.tld.')
+        with patch.object(client.log, 'info') as info:
+            client.apply()
+        assert [
+            call('_update_items: %d/%d entries sent', 1, 2),
+            call('_update_items: %d/%d entries sent', 2, 2),
+        ] == info.call_args_list[-2:]
+        assert [('DELETE', 'hosts'), ('PUT', 'hosts')] == [
+            (method, path.split('/')[4])
+            for method, path in stub_pihole.log
+            if method in ('DELETE', 'PUT')
+        ]
+        assert '10.1.1.1 new.stub.tld.' == stub_pihole.dns['hosts'][-1]
+
+        # without a delta it can only be sent whole
+        client.update({'hosts': []})
+        assert [] == stub_pihole.dns['hosts']
+        assert ('PATCH', '/api/config') == stub_pihole.log[-1]
+        client.logout()
+
     def test_add_cname_record(self):
-        self.client._cname_cache = []
+        client = PiholeClient(MOCK_URL, 'password')
+        # edits are made against a snapshot
+        client._snapshot = ([], [])
+        client._cname_cache = RecordStore()
 
         # adds entry to cname cache
-        self.client.add_cname_record('test.example.tld.', 'target.example.tld.')
-        assert 1 == len(self.client._cname_cache)
+        client.add_cname_record('test.example.tld.', 'target.example.tld.')
+        assert 1 == len(client._cname_cache)
 
         # does not duplicate entry in cname cache
-        self.client.add_cname_record('test.example.tld.', 'target.example.tld.')
-        assert 1 == len(self.client._cname_cache)
+        client.add_cname_record('test.example.tld.', 'target.example.tld.')
+        assert 1 == len(client._cname_cache)
 
     def test_add_host_record(self):
-        self.client._host_cache = []
+        client = PiholeClient(MOCK_URL, 'password')
+        # edits are made against a snapshot
+        client._snapshot = ([], [])
+        client._host_cache = RecordStore()
 
         # adds entry to host cache
-        self.client.add_host_record('1.1.1.1', 'target.example.tld.')
-        assert 1 == len(self.client._host_cache)
+        client.add_host_record('1.1.1.1', 'target.example.tld.')
+        assert 1 == len(client._host_cache)
 
         # does not duplicate entry in cname cache
-        self.client.add_host_record('1.1.1.1', 'target.example.tld.')
-        assert 1 == len(self.client._host_cache)
+        client.add_host_record('1.1.1.1', 'target.example.tld.')
+        assert 1 == len(client._host_cache)
 
     def test_apply(self):
         # Simple apply test - real values are tested from the provider test
-        orig_request = self.client._request
+        client = PiholeClient(MOCK_URL, 'password')
+        remote = {
+            'hosts': ['1.1.1.1 a.example.tld.'],
+            'cnameRecords': ['b.example.tld.,a.'],
+        }
 
-        resp = Mock()
-        self.client._request = Mock(return_value=resp)
+        def request(method, path, body=None, **kwargs):
+            remote.update(body.dns)
+            return Mock()
 
-        # Reset caches
-        self.client._cname_cache = []
-        self.client._host_cache = []
+        client._fetch_snapshot = Mock(
+            side_effect=lambda: (remote['hosts'], remote['cnameRecords'])
+        )
+        client._request = Mock(side_effect=request)
+        # nothing to compare with yet
+        assert client.delta({'hosts': []}) is None
+        client.snapshot()
 
-        self.client.apply()
+        # nothing modified, nothing sent
+        assert 0 == client.pending_age
+        client.apply()
+        client._request.assert_not_called()
 
-        self.client._request.assert_has_calls(
-            [
-                call(
-                    'PATCH',
-                    '/api/config',
-                    data={'config': {'dns': {'cnameRecords': [], 'hosts': []}}},
-                )
-            ]
+        # a delete and re-create nets out to nothing
+        client.delete_host_record('1.1.1.1', 'a.example.tld.')
+        client.add_host_record('1.1.1.1', 'a.example.tld.')
+        assert client.pending
+        client.apply()
+        client._request.assert_not_called()
+        assert not client.pending
+
+        # only modified lists are sent
+        client.add_host_record('2.2.2.2', 'c.example.tld.')
+        # the snapshot is kept while there are changes pending
+        client.invalidate()
+        assert client._snapshot
+        with patch.object(client.log, 'info') as info:
+            client.apply()
+        # what's skipped is logged, sized as it would have been encoded
+        size = len(json.dumps(['b.example.tld.,a.']))
+        info.assert_any_call(
+            'changes: %s unchanged, skipped %d entries, ~%d bytes',
+            'cnameRecords',
+            1,
+            size,
         )
+        client._request.assert_called_once()
+        patched = client._request.call_args
+        assert ('PATCH', '/api/config') == patched.args
+        assert {
+            'config': {
+                'dns': {
+                    'hosts': [
+                        '1.1.1.1 a.example.tld.',
+                        '2.2.2.2 c.example.tld.',
+                    ]
+                }
+            }
+        } == sent_json(patched.kwargs['body'])
+
+        # both when both were
+        client._request.reset_mock()
+        client.delete_host_record('1.1.1.1', 'a.example.tld.')
+        client.delete_cname_record('b.example.tld.', 'a.')
+        client.apply()
+        client._request.assert_called_once()
+        patched = client._request.call_args
+        assert ('PATCH', '/api/config') == patched.args
+        assert {
+            'config': {
+                'dns': {'cnameRecords': [], 'hosts': ['2.2.2.2 c.example.tld.']}
+            }
+        } == sent_json(patched.kwargs['body'])
+
+        # without a snapshot, e.g. after an update, edits start from a
+        # fresh one
+        client._request.reset_mock()
+        client.invalidate()
+        client.add_cname_record('c.example.tld.', 'a.')
+        assert 3 == client._fetch_snapshot.call_count
+        client.apply()
+        client._request.assert_called_once()
+        patched = client._request.call_args
+        assert ('PATCH', '/api/config') == patched.args
+        assert {
+            'config': {'dns': {'cnameRecords': ['c.example.tld.,a.']}}
+        } == sent_json(patched.kwargs['body'])
+
+    def test_update_items(self, mock_request):
+        hosts = [f'10.0.{i >> 8}.{i & 255} host-{i}.tld.' for i in range(6000)]
+        cnames = ['alias.tld.,host-0.tld.']
+        mock_request.get(
+            f"{MOCK_URL}/api/config/dns",
+            json={"config": {"dns": {"hosts": hosts, "cnameRecords": cnames}}},
+        )
+        mock_request.patch(f"{MOCK_URL}/api/config", json={})
+        items = f"{MOCK_URL}/api/config/dns"
+        mock_request.put(f"{items}/hosts/10.0.0.1%20new.tld.", json={})
+        mock_request.delete(f"{items}/hosts/10.0.0.0%20host-0.tld.", json={})
+        mock_request.delete(
+            f"{items}/cnameRecords/alias.tld.%2Chost-0.tld.", status_code=404
+        )
+
+        def sent():
+            requests = mock_request.request_history[seen:]
+            return [
+                (r.method, r.path)
+                for r in requests
+                if r.method not in ('GET', 'POST')
+            ]
+
+        # a few changes to long lists are sent entry by entry, removals
+        # first, with ones already gone being fine
+        client = PiholeClient(MOCK_URL, 'password')
+        client.snapshot()
+        client.add_host_record('10.0.0.1', 'new.tld.')
+        client.delete_host_record('10.0.0.0', 'host-0.tld.')
+        client.delete_cname_record('alias.tld.', 'host-0.tld.')
+        dns = {
+            'hosts': list(client._host_cache),
+            'cnameRecords': list(client._cname_cache),
+        }
+        assert {
+            'hosts': (['10.0.0.1 new.tld.'], ['10.0.0.0 host-0.tld.']),
+            'cnameRecords': ([], ['alias.tld.,host-0.tld.']),
+        } == client.delta(dns)
+        # logged in once up front, not by each call
+        client._forget_session()
+        seen = len(mock_request.request_history)
+        client.apply()
+        assert 2 == client.login_count
+        requests = sent()
+        assert 'PUT' == requests[-1][0]
+        assert [
+            ('DELETE', '/api/config/dns/cnamerecords/alias.tld.%2chost-0.tld.'),
+            ('DELETE', '/api/config/dns/hosts/10.0.0.0%20host-0.tld.'),
+            ('PUT', '/api/config/dns/hosts/10.0.0.1%20new.tld.'),
+        ] == sorted(requests)
+        assert client._snapshot is None
+
+        # many changes replace the lists
+        client = PiholeClient(MOCK_URL, 'password')
+        client.snapshot()
+        for i in range(10):
+            client.add_host_record('10.1.0.1', f'new-{i}.tld.')
+        seen = len(mock_request.request_history)
+        client.apply()
+        assert [('PATCH', '/api/config')] == sent()
+
+        # as does forcing it
+        client = PiholeClient(MOCK_URL, 'password', update_mode='patch')
+        client.snapshot()
+        client.add_host_record('10.0.0.1', 'new.tld.')
+        seen = len(mock_request.request_history)
+        client.apply()
+        assert [('PATCH', '/api/config')] == sent()
+
+        # and entry calls failing
+        client = PiholeClient(MOCK_URL, 'password', update_mode='items')
+        mock_request.put(f"{items}/hosts/10.0.0.1%20new.tld.", status_code=400)
+        client.snapshot()
+        client.add_host_record('10.0.0.1', 'new.tld.')
+        seen = len(mock_request.request_history)
+        with patch.object(client.log, 'warning') as warning:
+            client.apply()
+        warning.assert_called_once()
+        assert [
+            ('PUT', '/api/config/dns/hosts/10.0.0.1%20new.tld.'),
+            ('PATCH', '/api/config'),
+        ] == sent()
+
+        # only deletes tolerate missing entries
+        client._request = Mock(side_effect=PiholeClientNotFound())
+        with pytest.raises(PiholeClientNotFound):
+            client._update_item('PUT', 'hosts', '10.0.0.1 new.tld.')
+
+        with pytest.raises(PiholeClientException) as ctx:
+            PiholeClient(MOCK_URL, 'password', update_mode='nope')
+        assert 'Unknown update mode "nope"' == str(ctx.value)
+
+    def test_merge(self, stub_pihole):
+        stub_pihole.dns['hosts'] = ['1.1.1.1 a.tld.', '2.2.2.2 b.tld.']
+        client = PiholeClient(stub_pihole.url, 'password', merge=True)
+
+        def patches():
+            return len([r for r in stub_pihole.log if r[0] == 'PATCH'])
+
+        # entries added by others since the snapshot are kept
+        client.snapshot()
+        client.add_host_record('3.3.3.3', 'c.tld.')
+        client.delete_host_record('1.1.1.1', 'a.tld.')
+        stub_pihole.dns['hosts'].append('4.4.4.4 dhcp.tld.')
+        client.apply()
+        assert [
+            '2.2.2.2 b.tld.',
+            '4.4.4.4 dhcp.tld.',
+            '3.3.3.3 c.tld.',
+        ] == stub_pihole.dns['hosts']
+        assert 1 == patches()
+
+        # nothing is sent when Pi-hole already has our changes
+        client.snapshot()
+        client.add_cname_record('www.tld.', 'b.tld.')
+        stub_pihole.dns['cnameRecords'] = ['www.tld.,b.tld.']
+        client.apply()
+        assert 1 == patches()
 
-        # remove the mock on _request
-        self.client._request = orig_request
+        # conflicting changes aren't sent
+        client.snapshot()
+        client.add_cname_record('alias.tld.', 'b.tld.')
+        stub_pihole.dns['cnameRecords'].append('alias.tld.,c.tld.')
+        with pytest.raises(PiholeClientConflict) as ctx:
+            client.apply()
+        assert 'Conflicting changes to alias.tld.' == str(ctx.value)
+        assert 1 == patches()
+
+        # another writer racing us is retried, within limits
+        client.invalidate()
+        client.snapshot()
+        client.add_host_record('5.5.5.5', 'e.tld.')
+        remote = (list(stub_pihole.dns['hosts']), [])
+        client._fetch_snapshot = Mock(return_value=remote)
+        with pytest.raises(PiholeClientConflict) as ctx:
+            client.apply()
+        assert 'Changes did not stick after 3 attempts' == str(ctx.value)
+        assert 4 == client._fetch_snapshot.call_count
+        assert 4 == patches()
+
+        client.logout()
 
     def test_delete_cname_record(self):
-        self.client._cname_cache = ['cname.example.tld.,target.example.tld.']
+        client = PiholeClient(MOCK_URL, 'password')
+        # edits are made against a snapshot
+        client._snapshot = ([], [])
+        client._cname_cache = RecordStore(
+            ['cname.example.tld.,target.example.tld.']
+        )
 
         # valid delete
-        self.client.delete_cname_record(
-            'cname.example.tld.', 'target.example.tld.'
-        )
-        assert 0 == len(self.client._cname_cache)
+        client.delete_cname_record('cname.example.tld.', 'target.example.tld.')
+        assert 0 == len(client._cname_cache)
 
         # ignores errors when already deleted
-        self.client.delete_cname_record(
-            'cname.example.tld.', 'target.example.tld.'
-        )
+        client.delete_cname_record('cname.example.tld.', 'target.example.tld.')
         assert True  # Nothing should raise here
 
+    def test_replace_cname_record(self):
+        client = PiholeClient(MOCK_URL, 'password')
+        # edits are made against a snapshot
+        client._snapshot = ([], [])
+        client._cname_cache = RecordStore(
+            [
+                'cname.example.tld.,target.example.tld.',
+                'other.example.tld.,target.example.tld.',
+            ]
+        )
+
+        client.replace_cname_record(
+            'cname.example.tld.', 'target.example.tld.', 'new.example.tld.'
+        )
+        assert [
+            'cname.example.tld.,new.example.tld.',
+            'other.example.tld.,target.example.tld.',
+        ] == list(client._cname_cache)
+
     def test_delete_host_record(self):
-        self.client._host_cache = ['1.1.1.1 test.example.tld.']
+        client = PiholeClient(MOCK_URL, 'password')
+        # edits are made against a snapshot
+        client._snapshot = ([], [])
+        client._host_cache = RecordStore(['1.1.1.1 test.example.tld.'])
 
         # valid delete
-        self.client.delete_host_record('1.1.1.1', 'test.example.tld.')
-        assert 0 == len(self.client._host_cache)
+        client.delete_host_record('1.1.1.1', 'test.example.tld.')
+        assert 0 == len(client._host_cache)
 
         # ignores errors when already deleted
-        self.client.delete_host_record('1.1.1.1', 'test.example.tld.')
+        client.delete_host_record('1.1.1.1', 'test.example.tld.')
         assert True  # Nothing should raise here
 
     def test_get_cname_records(self, mock_request):
-        with open('tests/fixtures/cnameRecords.json') as fh:
+        with open('tests/fixtures/dns.json') as fh:
             fixture = json.load(fh)
 
         # valid response
-        mock_request.get(
-            f"{MOCK_URL}/api/config/dns/cnameRecords", json=fixture
-        )
+        self.client.invalidate()
+        mock_request.get(f"{MOCK_URL}/api/config/dns", json=fixture)
         assert (
             self.client.get_cname_records()
             == fixture["config"]["dns"]["cnameRecords"]
         )
 
         # unexpected response
+        self.client.invalidate()
         with pytest.raises(PiholeClientException):
-            mock_request.get(f"{MOCK_URL}/api/config/dns/cnameRecords", json={})
+            mock_request.get(f"{MOCK_URL}/api/config/dns", json={})
             self.client.get_cname_records()
 
     def test_get_host_records(self, mock_request):
-        with open('tests/fixtures/hosts.json') as fh:
+        with open('tests/fixtures/dns.json') as fh:
             fixture = json.load(fh)
 
         # valid response
-        mock_request.get(f"{MOCK_URL}/api/config/dns/hosts", json=fixture)
+        self.client.invalidate()
+        mock_request.get(f"{MOCK_URL}/api/config/dns", json=fixture)
         assert (
             self.client.get_host_records() == fixture["config"]["dns"]["hosts"]
         )
 
         # unexpected response
+        self.client.invalidate()
         with pytest.raises(PiholeClientException):
-            mock_request.get(f"{MOCK_URL}/api/config/dns/hosts", json={})
+            mock_request.get(f"{MOCK_URL}/api/config/dns", json={})
             self.client.get_host_records()
+
+    def test_zone_records(self, mock_request):
+        client = PiholeClient(MOCK_URL, 'password')
+        with open('tests/fixtures/dns.json') as fh:
+            mock_request.get(f"{MOCK_URL}/api/config/dns", json=json.load(fh))
+
+        assert {'', 'www', 'www.sub', 'aaaa', 'cname'} == {
+            name for name, _, _, _ in client.zone_records('unit.tests.')
+        }
+
+        # the index is reused while the snapshot is
+        index = client._index
+        list(client.zone_records('other.tld.'))
+        assert index is client._index
+
+        # including when a refetch finds the same content
+        client.invalidate()
+        list(client.zone_records('other.tld.'))
+        assert index is client._index
+
+        # and rebuilt when the content changed
+        client.invalidate()
+        mock_request.get(
+            f"{MOCK_URL}/api/config/dns",
+            json={"config": {"dns": {"cnameRecords": [], "hosts": []}}},
+        )
+        assert [] == list(client.zone_records('unit.tests.'))
+        assert index is not client._index
+
+        # entries with invalid addresses are skipped, with a warning
+        client.invalidate()
+        mock_request.get(
+            f"{MOCK_URL}/api/config/dns",
+            json={
+                "config": {
+                    "dns": {
+                        "cnameRecords": [
+                            "a.unit.tests.,unit.tests.",
+                            "a.unit.tests.,www.unit.tests.",
+                        ],
+                        "hosts": ["nope unit.tests.", "1.2.3.4 unit.tests."],
+                    }
+                }
+            },
+        )
+        with patch.object(client.log, 'warning') as warning:
+            assert [('', ['1.2.3.4'], [], [])] == [
+                r for r in client.zone_records('unit.tests.') if r[0] == ''
+            ]
+        warning.assert_called_once_with(
+            'ignoring invalid hosts entry "%s"', 'nope unit.tests.'
+        )
+
+    def test_stream(self, mock_request):
+        with open('tests/fixtures/dns.json') as fh:
+            fixture = json.load(fh)
+        fixture['config']['dns']['hosts'].append('nope bad.unit.tests.')
+        mock_request.get(f"{MOCK_URL}/api/config/dns", json=fixture)
+        mock_request.patch(f"{MOCK_URL}/api/config", json={})
+        client = PiholeClient(
+            MOCK_URL, 'password', stream=True, stream_zones=['unit.tests.']
+        )
+
+        with patch.object(client.log, 'warning') as warning:
+            assert {'', 'www', 'www.sub', 'aaaa', 'cname'} == {
+                name for name, _, _, _ in client.zone_records('unit.tests.')
+            }
+        warning.assert_called_once_with(
+            'ignoring invalid hosts entry "%s"', 'nope bad.unit.tests.'
+        )
+        assert 1 == fetches(mock_request)
+        # nothing outside of the streamed zones is held on to
+        assert client._snapshot is None
+        assert 6 == len(client._streamed.addresses)
+
+        # reused for covered zones
+        list(client.zone_records('sub.unit.tests.'))
+        assert 1 == fetches(mock_request)
+        # and streamed again, keeping both, for others
+        assert [('', ['1.1.1.1'], [], [])] == list(
+            client.zone_records('dont-touch-me-a.other.tld.')
+        )
+        assert 2 == fetches(mock_request)
+        assert {'unit.tests.', 'dont-touch-me-a.other.tld.'} == set(
+            client._streamed.zones
+        )
+
+        # edits load the full snapshot so that nothing else is lost
+        client.add_host_record('10.0.0.1', 'new.unit.tests.')
+        assert 3 == fetches(mock_request)
+        client.apply()
+        sent = sent_json(mock_request.request_history[-1].body)
+        assert (
+            fixture['config']['dns']['hosts'] + ['10.0.0.1 new.unit.tests.']
+            == sent['config']['dns']['hosts']
+        )
+
+        # after which zones are streamed again
+        list(client.zone_records('unit.tests.'))
+        assert 4 == fetches(mock_request)
+
+        # unexpected response
+        client.invalidate()
+        mock_request.get(f"{MOCK_URL}/api/config/dns", json={})
+        with pytest.raises(PiholeClientException) as ctx:
+            client.zone_records('unit.tests.')
+        assert 'Unexpected response gathering DNS config' == str(ctx.value)
+
+    def test_disk_cache(self, mock_request, tmp_path):
+        with open('tests/fixtures/dns.json') as fh:
+            fixture = json.load(fh)
+        mock_request.get(f"{MOCK_URL}/api/config/dns", json=fixture)
+        mock_request.patch(f"{MOCK_URL}/api/config", json={})
+
+        # a fetched snapshot is written to the cache
+        client = PiholeClient(MOCK_URL, 'password', cache_dir=str(tmp_path))
+        hosts = client.get_host_records()
+        assert 1 == fetches(mock_request)
+        assert [client._cache_path] == [str(p) for p in tmp_path.iterdir()]
+
+        # and used by the next client without fetching
+        client = PiholeClient(MOCK_URL, 'password', cache_dir=str(tmp_path))
+        assert hosts == client.get_host_records()
+        assert 1 == fetches(mock_request)
+        assert not client._verified
+
+        # other urls have their own
+        other = PiholeClient(
+            'http://other.mock', 'password', cache_dir=str(tmp_path)
+        )
+        assert other._cached is None
+
+        # once expired the snapshot is revalidated, unchanged content is
+        # kept as is
+        snapshot = client.snapshot()
+        client._cached['fetched_at'] -= client.cache_ttl
+        client.invalidate()
+        assert snapshot is client.snapshot()
+        assert 2 == fetches(mock_request)
+        assert client._verified
+
+        # updating before Pi-hole confirmed a cached snapshot checks it first
+        client = PiholeClient(MOCK_URL, 'password', cache_dir=str(tmp_path))
+        client.get_host_records()
+        client.add_host_record('10.0.0.1', 'new.unit.tests.')
+        client.apply()
+        assert 3 == fetches(mock_request)
+        # and the now outdated cache is dropped
+        assert [] == list(tmp_path.iterdir())
+
+        # refusing to update when Pi-hole changed since
+        client.get_host_records()
+        client = PiholeClient(MOCK_URL, 'password', cache_dir=str(tmp_path))
+        client.get_host_records()
+        client.add_host_record('10.0.0.1', 'new.unit.tests.')
+        mock_request.get(
+            f"{MOCK_URL}/api/config/dns",
+            json={"config": {"dns": {"cnameRecords": [], "hosts": []}}},
+        )
+        with pytest.raises(PiholeClientException) as ctx:
+            client.apply()
+        assert 'Pi-hole changed since the cached snapshot was taken' == str(
+            ctx.value
+        )
+
+        # a cache for another url is ignored, as are broken ones
+        with open(client._cache_path, 'w') as fh:
+            json.dump({'url': 'http://other.mock'}, fh)
+        assert (
+            PiholeClient(MOCK_URL, 'p', cache_dir=str(tmp_path))._cached is None
+        )
+        with open(client._cache_path, 'w') as fh:
+            fh.write('{')
+        assert (
+            PiholeClient(MOCK_URL, 'p', cache_dir=str(tmp_path))._cached is None
+        )
+
+        # dropping a missing cache is fine
+        client._forget_cache()
+        client._forget_cache()
+
+    def test_snapshot(self, mock_request):
+        client = PiholeClient(MOCK_URL, 'password')
+        with open('tests/fixtures/dns.json') as fh:
+            mock_request.get(f"{MOCK_URL}/api/config/dns", json=json.load(fh))
+
+        # hosts and CNAMEs come from a single, shared, fetch
+        client.get_host_records()
+        client.get_cname_records()
+        client.get_host_records()
+        assert 1 == fetches(mock_request)
+
+        # refetched once stale
+        client._snapshot_at -= client.snapshot_ttl + 1
+        client.get_host_records()
+        assert 2 == fetches(mock_request)
+
+        # and after being invalidated by an apply
+        mock_request.patch(f"{MOCK_URL}/api/config", json={})
+        client.add_host_record('10.0.0.1', 'new.unit.tests.')
+        client.apply()
+        client.get_cname_records()
+        assert 3 == fetches(mock_request)
+
+        # a ttl of 0 disables sharing
+        client.snapshot_ttl = 0
+        client._snapshot_at -= 1
+        client.get_cname_records()
+        assert 4 == fetches(mock_request)
@@ -0,0 +1,106 @@
+#
+#
+#
+
+from unittest.mock import patch
+
+from octodns.provider.yaml import YamlProvider
+from octodns.zone import Zone
+
+from octodns_pihole import PiholeClient, PiholeProvider
+from octodns_pihole.export import export, main
+
+
+def records(zone):
+    return sorted(
+        (r.name, r._type, r.data.get('value', r.data.get('values')))
+        for r in zone.records
+    )
+
+
+class TestExport:
+    def test_export(self, stub_pihole, tmp_path):
+        # host-2 before host-10, in octoDNS's natural order
+        stub_pihole.fill(hosts=12, cnames=3, zone='lan.')
+        stub_pihole.fill(hosts=2, zone='home.arpa.')
+        stub_pihole.dns['hosts'] += [
+            '10.0.0.2 lan.',
+            '10.0.0.3 lan.',
+            '2001:DB8::1:2:3:4 lan.',
+            '10.0.0.4 true.lan.',
+            '10.0.0.5 *.lan.',
+            '10.0.0.6 1.lan.',
+            'bad host.lan.',
+        ]
+        stub_pihole.dns['cnameRecords'] += [
+            'www.lan.,host-0.lan.',
+            # only the first target is a record
+            'www.lan.,other.lan.',
+        ]
+        client = PiholeClient(stub_pihole.url, 'password')
+        stats = export(client, tmp_path, depth=1)
+        assert 2 == stats['zones']
+        assert 26 == stats['entries']
+        assert 1 == stats['skipped']
+        assert {'arpa.yaml', 'lan.yaml'} == {p.name for p in tmp_path.iterdir()}
+
+        # everything loads back, in order, as populate has it
+        source = YamlProvider('export', str(tmp_path), enforce_order=True)
+        provider = PiholeProvider('test', stub_pihole.url, 'password')
+        total = 0
+        for name in ('lan.', 'arpa.'):
+            dumped = Zone(name, [])
+            source.populate(dumped)
+            expected = Zone(name, [])
+            provider.populate(expected)
+            assert records(expected) == records(dumped)
+            total += len(dumped.records)
+        assert stats['records'] == total
+        provider.close()
+
+        # or limited to zones, anything outside of them is skipped, names
+        # matched regardless of case
+        stub_pihole.dns['hosts'].append('10.0.0.1 Mixed.Home.Arpa.')
+        client.invalidate()
+        stats = export(client, tmp_path / 'zones', zones=['home.arpa.'])
+        assert 1 == stats['zones']
+        assert 24 == stats['skipped']
+        dumped = Zone('home.arpa.', [])
+        YamlProvider('export', str(tmp_path / 'zones')).populate(dumped)
+        assert {'host-0', 'host-1', 'mixed'} == {r.name for r in dumped.records}
+        client.logout()
+
+    def test_dotless(self, stub_pihole, tmp_path):
+        # as added through Pi-hole's UI
+        stub_pihole.dns['hosts'] = [
+            '192.168.1.10 nas.lan',
+            '192.168.1.11 printer.home.lan',
+        ]
+        stub_pihole.dns['cnameRecords'] = ['www.lan,nas.lan']
+        client = PiholeClient(stub_pihole.url, 'password')
+        expected = {
+            ('nas', 'A', '192.168.1.10'),
+            ('printer.home', 'A', '192.168.1.11'),
+            ('www', 'CNAME', 'nas.lan.'),
+        }
+        for directory, zones in (('depth', ()), ('zones', ['lan.', 'home'])):
+            stats = export(client, tmp_path / directory, zones=zones)
+            assert 0 == stats['skipped']
+            assert ['lan.yaml'] == [
+                p.name for p in (tmp_path / directory).iterdir()
+            ]
+            dumped = Zone('lan.', [])
+            YamlProvider('export', str(tmp_path / directory)).populate(dumped)
+            assert expected == set(records(dumped))
+        client.logout()
+
+    def test_main(self, stub_pihole, tmp_path, capsys, caplog):
+        stub_pihole.fill(hosts=2, zone='lan.')
+        # written out as it is, warned about
+        stub_pihole.dns['cnameRecords'].append('host-0.lan.,host-1.lan.')
+        with patch.dict('os.environ', {'PIHOLE_PASSWORD': 'password'}):
+            main([stub_pihole.url, str(tmp_path), '--zone', 'lan.'])
+        assert (tmp_path / 'lan.yaml').exists()
+        assert '3 entries, 3 records in 1 zones' in capsys.readouterr().out
+        assert 'CNAME host-0.lan. has other records' in caplog.text
+        assert not stub_pihole.sids
@@ -0,0 +1,180 @@
+#
+#
+#
+
+import json
+import shutil
+from os.path import dirname, join
+from sys import modules
+
+import pytest
+
+from octodns.provider.plan import Plan
+from octodns.record import Record
+from octodns.zone import Zone
+
+from octodns_pihole import PiholeClientException, PiholeProvider
+from octodns_pihole.file import PiholeFileClient, toml_replace
+
+FIXTURE = join(dirname(__file__), 'fixtures', 'dns.json')
+
+TOML = '''# Pi-hole configuration file (v6.0)
+
+[dns]
+  upstreams = [
+    "9.9.9.9"
+  ] ### CHANGED, default = []
+
+  # Array of custom DNS records, e.g. "127.0.0.1 example.com"
+  hosts = [
+    "1.2.3.4 unit.tests.", # trailing ] and # are ignored
+    '10.0.0.1 literal.unit.tests.'
+  ] ### CHANGED, default = []
+
+  domainNeeded = true
+
+  cnameRecords = [] # none yet
+
+[dhcp]
+  hosts = [
+    "dont-touch-me"
+  ]
+'''
+
+
+def _plan(provider, zone):
+    desired = Zone('unit.tests.', [])
+    for name, _type, value in (
+        ('', 'A', '1.2.3.4'),
+        ('new', 'AAAA', '2001:db8::1'),
+        ('www', 'CNAME', 'unit.tests.'),
+    ):
+        desired.add_record(
+            Record.new(
+                desired, name, {'type': _type, 'ttl': 86400, 'value': value}
+            )
+        )
+    changes = zone.changes(desired, provider)
+    return Plan(zone, desired, changes, True)
+
+
+class TestPiholeFileClient:
+    def test_json(self, tmp_path):
+        path = tmp_path / 'dns.json'
+        shutil.copy(FIXTURE, path)
+
+        provider = PiholeProvider('test', f'file://{path}', transport='file')
+        assert isinstance(provider._client, PiholeFileClient)
+        zone = Zone('unit.tests.', [])
+        provider.populate(zone)
+        assert 5 == len(zone.records)
+
+        provider.apply(_plan(provider, zone))
+        data = json.loads(path.read_text())
+        # only the lists are replaced, the rest is left as it was
+        assert 0.000026464462280273438 == data['took']
+        dns = data['config']['dns']
+        assert [
+            '1.1.1.1 dont-touch-me-a.other.tld.',
+            '2001:db8:: dont-touch-me-aaaa.other.tld.',
+            '1.2.3.4 unit.tests.',
+            '2001:db8::1 new.unit.tests.',
+        ] == dns['hosts']
+        assert [
+            'dont-touch-me.other.tld.,target.other.tld.',
+            'www.unit.tests.,unit.tests.',
+        ] == dns['cnameRecords']
+        assert not (tmp_path / 'dns.json.tmp').exists()
+
+        # and a fresh provider sees the changes
+        provider.close()
+        provider = PiholeProvider('test', str(path), transport='file')
+        zone = Zone('unit.tests.', [])
+        provider.populate(zone)
+        assert not _plan(provider, zone).changes
+        provider.close()
+
+    def test_toml(self, tmp_path):
+        # new in Python 3.11
+        tomllib = pytest.importorskip('tomllib')
+        path = tmp_path / 'pihole.toml'
+        path.write_text(TOML)
+
+        provider = PiholeProvider(
+            'test', str(path), transport='octodns_pihole.file.PiholeFileClient'
+        )
+        zone = Zone('unit.tests.', [])
+        provider.populate(zone)
+        assert {'', 'literal'} == {r.name for r in zone.records}
+
+        provider.apply(_plan(provider, zone))
+        text = path.read_text()
+        config = tomllib.loads(text)
+        dns = config['dns']
+        hosts = ['1.2.3.4 unit.tests.', '2001:db8::1 new.unit.tests.']
+        assert hosts == dns['hosts']
+        assert ['www.unit.tests.,unit.tests.'] == dns['cnameRecords']
+        # everything else is untouched, comments included
+        assert ['9.9.9.9'] == dns['upstreams']
+        assert dns['domainNeeded']
+        assert ['dont-touch-me'] == config['dhcp']['hosts']
+        assert '  # Array of custom DNS records' in text
+        assert '  ] ### CHANGED, default = []' in text
+        provider.close()
+
+    def test_toml_replace(self):
+        # new in Python 3.11
+        tomllib = pytest.importorskip('tomllib')
+        # missing keys are added to the table
+        text = toml_replace(
+            '[dns]\n  port = 53\n[dhcp]\n', 'dns', {'hosts': ['a'], 'x': []}
+        )
+        dns = tomllib.loads(text)['dns']
+        assert {'hosts': ['a'], 'port': 53, 'x': []} == dns
+
+        # as are nested arrays
+        text = toml_replace('[dns]\nhosts = [[1], [2]]\n', 'dns', {'hosts': []})
+        assert {'hosts': []} == tomllib.loads(text)['dns']
+
+        with pytest.raises(PiholeClientException, match='No \\[dns\\] table'):
+            toml_replace('[dhcp]\n', 'dns', {'hosts': []})
+        with pytest.raises(PiholeClientException, match='Unterminated'):
+            toml_replace('[dns]\nhosts = ["a"', 'dns', {'hosts': []})
+        with pytest.raises(PiholeClientException, match='Unterminated'):
+            toml_replace('[dns]\nhosts = [ # "a"', 'dns', {'hosts': []})
+
+    def test_errors(self, tmp_path, monkeypatch):
+        client = PiholeFileClient(str(tmp_path / 'missing.json'))
+        with pytest.raises(PiholeClientException, match='Unable to read'):
+            client.snapshot()
+
+        path = tmp_path / 'dns.json'
+        path.write_text('{"dns": {}}')
+        client = PiholeFileClient(str(path))
+        with pytest.raises(PiholeClientException, match='Unexpected DNS'):
+            client.snapshot()
+
+        # tomllib is new in Python 3.11
+        monkeypatch.setitem(modules, 'tomllib', None)
+        with pytest.raises(PiholeClientException, match='needs Python 3.11'):
+            PiholeFileClient(str(tmp_path / 'pihole.toml'))
+
+    def test_stream(self, tmp_path):
+        path = tmp_path / 'dns.json'
+        shutil.copy(FIXTURE, path)
+        # whatever's asked for, there are no sessions or per entry calls
+        client = PiholeFileClient(
+            str(path), 'password', stream=True, update_mode='items'
+        )
+        assert client.authorized
+        assert 'patch' == client.update_mode
+        assert [
+            ('', ['1.2.3.4', '1.2.3.5'], [], []),
+            ('aaaa', [], ['2601:644:500:e210:62f8:1dff:feb8:947a'], []),
+            ('cname', [], [], ['unit.tests.']),
+            ('www', ['2.2.3.6'], [], []),
+            ('www.sub', ['2.2.3.6'], [], []),
+        ] == sorted(client.zone_records('unit.tests.'))
+        # read as the file was streamed, not snapshotted
+        assert client._snapshot is None
+        client.logout()
@@ -0,0 +1,172 @@
+#
+#
+#
+
+from unittest.mock import patch
+
+import pytest
+
+from octodns.provider import ProviderException
+
+from octodns_pihole.reconcile import Reconciler, main
+
+CONFIG = '''---
+providers:
+  yaml:
+    class: octodns.provider.yaml.YamlProvider
+    directory: {directory}
+  pihole:
+    class: octodns_pihole.PiholeProvider
+    url: {url}
+    password: password
+zones:
+  lan.:
+    sources:
+      - yaml
+    targets:
+      - pihole
+'''
+
+
+@pytest.fixture
+def config(stub_pihole, tmp_path):
+    directory = tmp_path / 'zones'
+    directory.mkdir()
+    (directory / 'lan.yaml').write_text(
+        '---\nhost:\n  type: A\n  value: 10.0.0.1\n'
+    )
+    path = tmp_path / 'config.yaml'
+    path.write_text(CONFIG.format(directory=directory, url=stub_pihole.url))
+    return path
+
+
+class TestReconciler:
+    def test_reconcile(self, stub_pihole, config):
+        reconciler = Reconciler(str(config), interval=0, dry_run=False)
+
+        # the first pass syncs
+        assert reconciler.reconcile()
+        assert ['10.0.0.1 host.lan.'] == stub_pihole.dns['hosts']
+
+        # without drift a pass is a single request
+        requests = len(stub_pihole.log)
+        assert not reconciler.reconcile()
+        assert [('GET', '/api/config/dns')] == stub_pihole.log[requests:]
+
+        # drift on Pi-hole's side is undone
+        stub_pihole.dns['hosts'].append('10.0.0.2 other.lan.')
+        assert reconciler.reconcile()
+        assert ['10.0.0.1 host.lan.'] == stub_pihole.dns['hosts']
+
+        # as are changes to the sources
+        (config.parent / 'zones' / 'lan.yaml').write_text(
+            '---\nhost:\n  type: A\n  value: 10.0.0.3\n'
+        )
+        assert reconciler.reconcile()
+        assert ['10.0.0.3 host.lan.'] == stub_pihole.dns['hosts']
+        assert not reconciler.reconcile()
+
+        # all over a single session
+        assert 1 == stub_pihole.logins
+        assert {
+            'passes': 5,
+            'skipped': 2,
+            'synced': 3,
+            'failed': 0,
+        } == reconciler.stats
+        assert 5 == reconciler.timings['poll'][0]
+        assert 3 == reconciler.timings['sync'][0]
+        assert 'passes=5 skipped=2 synced=3 failed=0' in reconciler.summary()
+
+        # sources it can't see into are synced every so often
+        reconciler.max_skips = 1
+        assert reconciler.reconcile()
+        assert not reconciler.reconcile()
+        assert reconciler.reconcile()
+
+        # a changed config is reloaded, logging in again
+        config.write_text(config.read_text() + '\n')
+        assert reconciler.reconcile()
+        assert 2 == stub_pihole.logins
+
+        reconciler.close()
+        assert not stub_pihole.sids
+
+    def test_batch_apply(self, stub_pihole, config):
+        config.write_text(
+            config.read_text().replace(
+                '    password: password\n',
+                '    password: password\n    batch_apply: true\n',
+            )
+        )
+        reconciler = Reconciler(str(config), dry_run=False)
+
+        # deferred changes are sent before Pi-hole is hashed again
+        assert reconciler.reconcile()
+        assert ['10.0.0.1 host.lan.'] == stub_pihole.dns['hosts']
+        assert not any(p._client.pending for p in reconciler.providers)
+        assert not reconciler.reconcile()
+        reconciler.close()
+
+    def test_dry_run(self, stub_pihole, config):
+        reconciler = Reconciler(str(config))
+        assert reconciler.reconcile()
+        # planned, not applied
+        assert [] == stub_pihole.dns['hosts']
+        assert not reconciler.reconcile()
+        reconciler.close()
+
+    def test_run(self, stub_pihole, config, tmp_path):
+        reconciler = Reconciler(str(config), interval=0)
+        reconciler.run(passes=2)
+        assert {
+            'passes': 2,
+            'skipped': 1,
+            'synced': 1,
+            'failed': 0,
+        } == reconciler.stats
+
+        # failed passes are retried until stopped
+        reconciler.config_file = str(tmp_path / 'missing.yaml')
+        with patch.object(reconciler._stop, 'wait') as wait:
+            wait.side_effect = lambda _: reconciler.stop()
+            reconciler.run()
+        assert 1 == reconciler.stats['failed']
+        reconciler.close()
+
+        # there has to be a Pi-hole to reconcile
+        config.write_text(
+            f'''---
+providers:
+  yaml:
+    class: octodns.provider.yaml.YamlProvider
+    directory: {tmp_path / 'zones'}
+zones:
+  lan.:
+    sources:
+      - yaml
+    targets:
+      - yaml
+'''
+        )
+        reconciler = Reconciler(str(config))
+        with pytest.raises(ProviderException, match='No PiholeProvider'):
+            reconciler.reconcile()
+        reconciler.close()
+
+    def test_main(self, config):
+        with patch.object(
+            Reconciler, 'run', side_effect=KeyboardInterrupt
+        ) as run, patch(
+            'sys.argv',
+            [
+                'octodns-pihole-reconcile',
+                '--config-file',
+                str(config),
+                '--interval',
+                '5',
+                '--doit',
+            ],
+        ):
+            main()
+        run.assert_called_once()
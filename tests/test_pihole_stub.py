@@ -0,0 +1,119 @@
+#
+#
+#
+
+from time import monotonic
+from unittest.mock import patch
+
+import pytest
+from requests import Session
+
+from octodns_pihole import PiholeClient
+from octodns_pihole.stub import StubPihole, main
+
+
+class TestStubPihole:
+    def test_sessions(self, stub_pihole):
+        http = Session()
+        url = f'{stub_pihole.url}/api/config/dns'
+        assert 401 == http.get(url).status_code
+
+        resp = http.post(
+            f'{stub_pihole.url}/api/auth', json={'password': 'wrong'}
+        )
+        assert 401 == resp.status_code
+
+        resp = http.post(
+            f'{stub_pihole.url}/api/auth', json={'password': 'password'}
+        )
+        session = resp.json()['session']
+        assert {'sid': 'sid-1', 'validity': 1800} == session
+        http.headers['sid'] = session['sid']
+        assert 200 == http.get(url).status_code
+
+        # sessions expire
+        stub_pihole.sids['sid-1'] = monotonic() - 1
+        assert 401 == http.get(url).status_code
+
+        # and can be ended
+        stub_pihole.sids['sid-1'] = monotonic() + 60
+        assert 204 == http.delete(f'{stub_pihole.url}/api/auth').status_code
+        assert not stub_pihole.sids
+        http.close()
+
+    def test_lists(self, stub_pihole):
+        stub_pihole.fill(hosts=4, cnames=5)
+        assert [
+            '10.0.0.0 host-0.stub.tld.',
+            '2001:db8::0:1 host-1.stub.tld.',
+            '10.0.0.2 host-2.stub.tld.',
+            '2001:db8::0:3 host-3.stub.tld.',
+        ] == stub_pihole.dns['hosts']
+        assert 'alias-4.stub.tld.,host-0.stub.tld.' == (
+            stub_pihole.dns['cnameRecords'][-1]
+        )
+        # without hosts CNAMEs point at the zone
+        server = StubPihole().fill(cnames=1, zone='x.')
+        assert ['alias-0.x.,x.'] == server.dns['cnameRecords']
+        server.server_close()
+
+        client = PiholeClient(stub_pihole.url, 'password', update_mode='items')
+        assert 4 == len(client.get_host_records())
+        resp = client._request('GET', '/api/config/dns/cnameRecords').json()
+        assert 5 == len(resp['config']['dns']['cnameRecords'])
+
+        # entries are added and removed one at a time
+        client.add_host_record('10.1.1.1', 'new.stub.tld.')
+        client.delete_cname_record('alias-0.stub.tld.', 'host-0.stub.tld.')
+        client.apply()
+        assert '10.1.1.1 new.stub.tld.' == stub_pihole.dns['hosts'][-1]
+        assert 4 == len(stub_pihole.dns['cnameRecords'])
+        assert ('PUT', '/api/config/dns/hosts/10.1.1.1%20new.stub.tld.') in (
+            stub_pihole.log
+        )
+        assert 0 < stub_pihole.bytes_received < stub_pihole.bytes_sent
+
+        # duplicates are refused, as are removing what isn't there
+        path = '/api/config/dns/hosts/10.1.1.1%20new.stub.tld.'
+        with pytest.raises(Exception) as ctx:
+            client._request('PUT', path)
+        assert 400 == ctx.value.response.status_code
+        client._request('DELETE', path)
+        with pytest.raises(Exception) as ctx:
+            client._request('DELETE', path)
+        assert 'Not Found' == str(ctx.value)
+        client.logout()
+
+    def test_latency_and_errors(self, stub_pihole):
+        client = PiholeClient(
+            stub_pihole.url, 'password', retries=0, backoff_factor=0
+        )
+        client._authorize()
+
+        stub_pihole.latency = 0.05
+        start = monotonic()
+        client.get_host_records()
+        assert monotonic() - start >= 0.05
+        stub_pihole.latency = 0
+
+        stub_pihole.errors.append(500)
+        client.invalidate()
+        with pytest.raises(Exception) as ctx:
+            client.get_host_records()
+        assert 500 == ctx.value.response.status_code
+        assert 'Injected error' == ctx.value.response.json()['error']['message']
+
+        # a seeded rate fails a repeatable share of requests
+        server = StubPihole(error_rate=0.5, seed=1)
+        failures = [server.injected_error() for _ in range(100)]
+        assert {None, 503} == set(failures)
+        assert 30 < failures.count(503) < 70
+        server.server_close()
+        client.logout()
+
+    def test_main(self):
+        with patch.object(
+            StubPihole, 'serve_forever', side_effect=KeyboardInterrupt
+        ) as serve:
+            main(['--port', '0', '--hosts', '10', '--latency', '0.1', '--gzip'])
+        serve.assert_called_once()
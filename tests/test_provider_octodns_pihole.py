@@ -4,18 +4,33 @@
 
 import json
 from os.path import dirname, join
-from unittest.mock import Mock, call
+from unittest.mock import Mock, call, patch
+from weakref import WeakSet
 
 import pytest
-from conftest import MOCK_URL
+from conftest import MOCK_URL, plan_zone, sent_json
 from requests import HTTPError
 from requests_mock import ANY
 
+from octodns.idna import IdnaError
+from octodns.provider import ProviderException
 from octodns.provider.yaml import YamlProvider
-from octodns.record import Record
+from octodns.record import Record, ValidationError
 from octodns.zone import Zone
 
-from octodns_pihole import PiholeProvider
+from octodns_pihole import (
+    PiholeClientException,
+    PiholeFleet,
+    PiholeFleetException,
+    PiholeProvider,
+)
+
+# reported to by test_metrics
+METRICS = []
+
+
+def record_metric(name, value, tags):
+    METRICS.append((name, value, tags))
 
 
 class TestPiholeProvider:
@@ -55,6 +70,7 @@ class TestPiholeProvider:
         assert 502 == ctx.value.response.status_code
 
         # Non-existent zone doesn't populate anything
+        provider._client.invalidate()
         mock_request.get(
             ANY,
             status_code=200,
@@ -66,12 +82,9 @@ class TestPiholeProvider:
         assert set() == zone.records
 
         # No diffs == no changes
-        with open('tests/fixtures/cnameRecords.json') as fh:
-            url = f"{MOCK_URL}/api/config/dns/cnameRecords"
-            mock_request.get(url, json=json.load(fh))
-
-        with open('tests/fixtures/hosts.json') as fh:
-            url = f"{MOCK_URL}/api/config/dns/hosts"
+        provider._client.invalidate()
+        with open('tests/fixtures/dns.json') as fh:
+            url = f"{MOCK_URL}/api/config/dns"
             mock_request.get(url, json=json.load(fh))
 
         zone = Zone('unit.tests.', [])
@@ -81,6 +94,271 @@ class TestPiholeProvider:
 
         changes = self.expected.changes(zone, provider)
         assert 6 == len(changes)  # TODO - understand why this is 6??
+        # 4 only differ in TTL and 1 in geo, which Pi-hole doesn't have
+        included = [c for c in changes if provider._include_change(c)]
+        assert 1 == len(included)
+
+        # the bad auth retried once, everything after reused a single session
+        assert 2 == provider._client.login_count
+
+        # other zones are populated from the same snapshot
+        gets = mock_request.call_count
+        zone = Zone('other.tld.', [])
+        provider.populate(zone)
+        assert 3 == len(zone.records)
+        assert gets == mock_request.call_count
+
+        provider.close()
+        assert 'DELETE' == mock_request.last_request.method
+
+        # streamed, the same records without holding on to the snapshot
+        provider = PiholeProvider(
+            'test', MOCK_URL, 'password', stream=True, stream_zones=['lan.']
+        )
+        zone = Zone('unit.tests.', [])
+        provider.populate(zone)
+        assert 5 == len(zone.records)
+        assert provider._client._snapshot is None
+        assert {'lan.', 'unit.tests.'} == provider._client.stream_zones
+        provider.close()
+
+    def test_close(self, mock_request):
+        provider = PiholeProvider('test', MOCK_URL, 'password')
+        provider._client._authorize()
+
+        # failures to log out are logged, not raised
+        mock_request.delete(f"{MOCK_URL}/api/auth", status_code=500)
+        provider.close()
+
+        # and it only happens once
+        provider.close()
+        assert 2 == mock_request.call_count
+
+    def test_prefetch(self, stub_pihole):
+        with open('tests/fixtures/dns.json') as fh:
+            stub_pihole.dns = json.load(fh)['config']['dns']
+
+        def records(zone):
+            return sorted(
+                (r.name, r._type, r.data['ttl']) for r in zone.records
+            )
+
+        provider = PiholeProvider('test', stub_pihole.url, 'password')
+        expected = Zone('unit.tests.', [])
+        provider.populate(expected)
+        assert 5 == len(expected.records)
+
+        provider.prefetch(['unit.tests.', 'other.tld.'])
+        assert {'unit.tests.', 'other.tld.'} == set(provider._prefetched)
+        # the next populate of each zone uses it up
+        zone = Zone('unit.tests.', [])
+        assert provider.populate(zone)
+        assert records(expected) == records(zone)
+        assert {'other.tld.'} == set(provider._prefetched)
+
+        # and built across processes, the same records
+        provider.prefetch(['unit.tests.'], processes=2)
+        zone = Zone('unit.tests.', [])
+        provider.populate(zone)
+        assert records(expected) == records(zone)
+
+        # applying changes drops whatever is left
+        wanted = Zone('unit.tests.', [])
+        wanted.add_record(
+            Record.new(
+                wanted, 'b', {'ttl': 60, 'type': 'A', 'value': '2.2.2.2'}
+            )
+        )
+        plan = provider.plan(wanted)
+        provider.prefetch(['unit.tests.'])
+        provider.apply(plan)
+        assert {} == provider._prefetched
+        provider.close()
+
+        # configured zones are prefetched by the first populate of one
+        provider = PiholeProvider(
+            'test',
+            stub_pihole.url,
+            'password',
+            prefetch_zones=['unit.tests.', 'other.tld.'],
+        )
+        provider.populate(Zone('other.tld.', []))
+        assert {'unit.tests.'} == set(provider._prefetched)
+        assert not provider.prefetch_zones
+        provider.close()
+
+    def test_populate_invalid(self, stub_pihole):
+        provider = PiholeProvider('test', stub_pihole.url, 'password')
+
+        # targets without a trailing dot are only accepted leniently
+        stub_pihole.dns['cnameRecords'] = ['bad.unit.tests.,nodot']
+        provider.prefetch(['unit.tests.'])
+        with pytest.raises(ValidationError):
+            provider.populate(Zone('unit.tests.', []))
+        zone = Zone('unit.tests.', [])
+        provider.populate(zone, lenient=True)
+        assert 'nodot' == zone.records.pop().value
+
+        # as are names that can't be IDNA encoded
+        provider._client.invalidate()
+        stub_pihole.dns['cnameRecords'] = ['\u2603.unit.tests.,unit.tests.']
+        with pytest.raises(ValidationError):
+            provider.populate(Zone('unit.tests.', []))
+        with pytest.raises(IdnaError):
+            provider.populate(Zone('unit.tests.', []), lenient=True)
+        provider.close()
+
+    def test_drift(self, stub_pihole):
+        with open('tests/fixtures/dns.json') as fh:
+            stub_pihole.dns = json.load(fh)['config']['dns']
+
+        def planned(provider, desired):
+            plan = provider.plan(desired)
+            if plan is None:
+                return []
+            return sorted(
+                (c.__class__.__name__, c.record.fqdn, c.record._type)
+                for c in plan.changes
+            )
+
+        provider = PiholeProvider(
+            'test', stub_pihole.url, 'password', strict_supports=False
+        )
+        # the same changes as plan, unsupported records dropped
+        changes = provider.drift(self.expected)
+        assert planned(provider, self.expected) == changes
+        assert ('Create', 'included.unit.tests.', 'CNAME') in changes
+        assert 'Update' not in {c[0] for c in changes}
+
+        # none once Pi-hole matches
+        wanted = Zone('unit.tests.', [])
+        for name, data in (
+            ('', {'type': 'A', 'values': ['1.2.3.4', '1.2.3.5']}),
+            ('www', {'type': 'A', 'value': '2.2.3.6'}),
+            ('www.sub', {'type': 'A', 'value': '2.2.3.6'}),
+            ('cname', {'type': 'CNAME', 'value': 'unit.tests.'}),
+            (
+                'aaaa',
+                {
+                    'type': 'AAAA',
+                    'value': '2601:644:500:e210:62f8:1dff:feb8:947a',
+                },
+            ),
+        ):
+            wanted.add_record(Record.new(wanted, name, {'ttl': 60, **data}))
+        assert [] == provider.drift(wanted)
+        assert [] == planned(provider, wanted)
+
+        # Pi-hole's spelling of names and addresses doesn't matter
+        stub_pihole.dns['hosts'].append('2001:DB8::1 upper.unit.tests.')
+        stub_pihole.dns['cnameRecords'] += [
+            'Other.unit.tests.,Target.unit.tests.',
+            '☃.unit.tests.,unit.tests.',
+        ]
+        provider._client.invalidate()
+        wanted.add_record(
+            Record.new(
+                wanted,
+                'upper',
+                {'ttl': 60, 'type': 'AAAA', 'value': '2001:db8::1'},
+            )
+        )
+        wanted.add_record(
+            Record.new(
+                wanted,
+                'other',
+                {'ttl': 60, 'type': 'CNAME', 'value': 'target.unit.tests.'},
+            )
+        )
+        # the name that can't be encoded would be deleted
+        assert [('Delete', '☃.unit.tests.', 'CNAME')] == provider.drift(wanted)
+
+        # updates, and records skipped for this provider on either side
+        wanted.add_record(
+            Record.new(
+                wanted,
+                'www',
+                {'ttl': 60, 'type': 'A', 'values': ['2.2.3.6', '2.2.3.7']},
+            ),
+            replace=True,
+        )
+        wanted.add_record(
+            Record.new(
+                wanted,
+                'cname',
+                {
+                    'ttl': 60,
+                    'type': 'CNAME',
+                    'value': 'elsewhere.tld.',
+                    'octodns': {'excluded': ['test']},
+                },
+            ),
+            replace=True,
+        )
+        for name, octodns in (
+            ('ignored', {'ignored': True}),
+            ('excluded', {'excluded': ['test']}),
+            ('included', {'included': ['other']}),
+        ):
+            wanted.add_record(
+                Record.new(
+                    wanted,
+                    name,
+                    {
+                        'ttl': 60,
+                        'type': 'A',
+                        'value': '3.3.3.3',
+                        'octodns': octodns,
+                    },
+                )
+            )
+        assert [
+            ('Delete', '☃.unit.tests.', 'CNAME'),
+            ('Update', 'www.unit.tests.', 'A'),
+        ] == provider.drift(wanted)
+
+        # unsupported records are refused when strict
+        provider.strict_supports = True
+        with pytest.raises(ProviderException, match='not supported'):
+            provider.drift(self.expected)
+        provider.close()
+
+    def test_metrics(self, mock_request):
+        with pytest.raises(ProviderException) as ctx:
+            PiholeProvider('test', MOCK_URL, 'password', metrics='nowhere')
+        assert 'Unable to load metrics "nowhere"' == str(ctx.value)
+
+        provider = PiholeProvider(
+            'test',
+            MOCK_URL,
+            'password',
+            metrics='test_provider_octodns_pihole.record_metric',
+        )
+        assert provider.instrumentation.metrics is record_metric
+        mock_request.get(
+            f"{MOCK_URL}/api/config/dns",
+            json={
+                'config': {
+                    'dns': {
+                        'hosts': ['1.1.1.1 a.unit.tests.'],
+                        'cnameRecords': [],
+                    }
+                }
+            },
+        )
+        provider.populate(Zone('unit.tests.', []))
+        assert (
+            'phase.seconds',
+            {'phase': 'populate', 'zone': 'unit.tests.'},
+        ) in [(name, tags) for name, _, tags in METRICS]
+
+        # the run is summarized once closed
+        with patch.object(provider.log, 'info') as info:
+            provider.close()
+        _, summary = info.call_args.args
+        assert 'GET /api/config/dns' in summary
+        assert 'DELETE /api/auth' in summary
+        assert '\npopulate ' in summary
 
     def test_apply(self):
         provider = PiholeProvider(
@@ -101,94 +379,346 @@ class TestPiholeProvider:
         assert n == provider.apply(plan)
         assert not plan.exists
 
-        provider._client._request.assert_has_calls(
-            [
-                # get all current hosts
-                call('GET', '/api/config/dns/hosts'),
-                # get all current CNAMEs
-                call('GET', '/api/config/dns/cnameRecords'),
-                # applies the updated hosts/CNAMEs
-                call(
-                    'PATCH',
-                    '/api/config',
-                    data={
-                        'config': {
-                            'dns': {
-                                'cnameRecords': [
-                                    'cname.unit.tests.,unit.tests.',
-                                    'included.unit.tests.,unit.tests.',
-                                ],
-                                'hosts': [
-                                    '1.2.3.4 unit.tests.',
-                                    '1.2.3.5 unit.tests.',
-                                    '2601:644:500:e210:62f8:1dff:feb8:947a aaaa.unit.tests.',
-                                    '2.2.3.6 www.unit.tests.',
-                                    '2.2.3.6 www.sub.unit.tests.',
-                                ],
-                            }
-                        }
-                    },
-                ),
-            ]
-        )
-        assert 3 == provider._client._request.call_count
+        get, patch = provider._client._request.call_args_list
+        # get all current hosts and CNAMEs
+        assert call('GET', '/api/config/dns') == get
+        # applies the updated hosts/CNAMEs
+        assert ('PATCH', '/api/config') == patch.args
+        assert {
+            'config': {
+                'dns': {
+                    'cnameRecords': [
+                        'cname.unit.tests.,unit.tests.',
+                        'included.unit.tests.,unit.tests.',
+                    ],
+                    'hosts': [
+                        '1.2.3.4 unit.tests.',
+                        '1.2.3.5 unit.tests.',
+                        '2601:644:500:e210:62f8:1dff:feb8:947a aaaa.unit.tests.',
+                        '2.2.3.6 www.unit.tests.',
+                        '2.2.3.6 www.sub.unit.tests.',
+                    ],
+                }
+            }
+        } == sent_json(patch.kwargs['body'])
+        assert 2 == provider._client._request.call_count
 
         # reset mock
         provider._client._request.reset_mock()
-        # reset client caches
-        provider._client._cname_cache = [
-            "dont-touch-me.other.tld.,target.other.tld.",
-            "delete-me.unit.tests.,target.unit.tests.",
-        ]
-        provider._client._host_cache = [
-            "1.0.0.0 dont-touch-me.other.tld.",
-            "1.1.1.1 delete-me.unit.tests.",
-            "1.2.3.4 update-me.unit.tests.",
-        ]
-
-        # delete 2 and update 1
-        provider._client.get_cname_records = Mock(
-            return_value=provider._client._cname_cache
-        )
-        provider._client.get_host_records = Mock(
-            return_value=provider._client._host_cache
+        # Pi-hole's current hosts/CNAMEs
+        provider._client._fetch_snapshot = Mock(
+            return_value=(
+                [
+                    "1.0.0.0 dont-touch-me.other.tld.",
+                    "1.1.1.1 delete-me.unit.tests.",
+                    "1.2.3.4 update-me.unit.tests.",
+                    "1.2.3.5 update-me.unit.tests.",
+                ],
+                [
+                    "cname-me.unit.tests.,old.unit.tests.",
+                    "dont-touch-me.other.tld.,target.other.tld.",
+                    "delete-me.unit.tests.,target.unit.tests.",
+                ],
+            )
         )
 
+        # delete 2 and update 2
         wanted = Zone('unit.tests.', [])
         wanted.add_record(
             Record.new(
                 wanted,
                 'update-me',
-                {'ttl': 300, 'type': 'A', 'value': '3.2.3.4'},
+                {'ttl': 300, 'type': 'A', 'values': ['1.2.3.5', '3.2.3.4']},
+            )
+        )
+        wanted.add_record(
+            Record.new(
+                wanted,
+                'cname-me',
+                {'ttl': 300, 'type': 'CNAME', 'value': 'new.unit.tests.'},
             )
         )
 
         plan = provider.plan(wanted)
         assert plan.exists
-        assert 3 == len(plan.changes)
-        assert 3 == provider.apply(plan)
-
-        # expected update calls
-        provider._client._request.assert_has_calls(
-            [
-                # applies the updated hosts/CNAMEs
-                call(
-                    'PATCH',
-                    '/api/config',
-                    data={
-                        'config': {
-                            'dns': {
-                                'cnameRecords': [
-                                    "dont-touch-me.other.tld.,target.other.tld."
-                                ],
-                                'hosts': [
-                                    "1.0.0.0 dont-touch-me.other.tld.",
-                                    "3.2.3.4 update-me.unit.tests.",
-                                ],
-                            }
-                        }
-                    },
-                )
+        assert 4 == len(plan.changes)
+        assert 4 == provider.apply(plan)
+
+        # applies the updated hosts/CNAMEs
+        patch = provider._client._request.call_args
+        assert ('PATCH', '/api/config') == patch.args
+        assert {
+            'config': {
+                'dns': {
+                    # replaced in place
+                    'cnameRecords': [
+                        "cname-me.unit.tests.,new.unit.tests.",
+                        "dont-touch-me.other.tld.,target.other.tld.",
+                    ],
+                    # the unchanged value stays put
+                    'hosts': [
+                        "1.0.0.0 dont-touch-me.other.tld.",
+                        "1.2.3.5 update-me.unit.tests.",
+                        "3.2.3.4 update-me.unit.tests.",
+                    ],
+                }
+            }
+        } == sent_json(patch.kwargs['body'])
+        assert 1 == provider._client._request.call_count
+
+    def test_batch_apply(self, mock_request):
+        with open('tests/fixtures/dns.json') as fh:
+            mock_request.get(f"{MOCK_URL}/api/config/dns", json=json.load(fh))
+        mock_request.patch(f"{MOCK_URL}/api/config", json={})
+
+        def patches():
+            return [
+                sent_json(r.body)['config']['dns']
+                for r in mock_request.request_history
+                if r.method == 'PATCH'
             ]
+
+        provider = PiholeProvider(
+            'test', MOCK_URL, 'password', batch_apply=True
         )
-        assert 1 == provider._client._request.call_count
+
+        # plans for both zones
+        plans = [
+            plan_zone(provider, 'unit.tests.', 'batched', '10.0.0.1'),
+            plan_zone(provider, 'other.tld.', 'batched', '10.0.0.2'),
+        ]
+        for plan in plans:
+            provider.apply(plan)
+
+        # nothing sent until the provider is closed
+        assert [] == patches()
+        assert provider._client.pending
+
+        provider.close()
+        sent = patches()
+        assert 1 == len(sent)
+        # with the changes from both zones
+        assert '10.0.0.1 batched.unit.tests.' in sent[0]['hosts']
+        assert '10.0.0.2 batched.other.tld.' in sent[0]['hosts']
+        assert not provider._client.pending
+
+        # closing again doesn't resend
+        provider.close()
+        assert 1 == len(patches())
+
+        # flushes as soon as batch_max_changes is reached
+        provider = PiholeProvider(
+            'test', MOCK_URL, 'password', batch_apply=True, batch_max_changes=1
+        )
+        provider.apply(
+            plan_zone(provider, 'unit.tests.', 'batched', '10.0.0.3')
+        )
+        assert 2 == len(patches())
+        provider.close()
+
+        # or batch_max_age has passed
+        provider = PiholeProvider(
+            'test', MOCK_URL, 'password', batch_apply=True, batch_max_age=60
+        )
+        provider.apply(
+            plan_zone(provider, 'unit.tests.', 'batched', '10.0.0.4')
+        )
+        assert 2 == len(patches())
+        provider._client._pending_since -= 61
+        provider.apply(plan_zone(provider, 'other.tld.', 'batched', '10.0.0.5'))
+        assert 3 == len(patches())
+        provider.close()
+
+        # a failure to send deferred changes raises from close
+        provider = PiholeProvider(
+            'test', MOCK_URL, 'password', batch_apply=True
+        )
+        provider.apply(
+            plan_zone(provider, 'unit.tests.', 'batched', '10.0.0.6')
+        )
+        mock_request.patch(f"{MOCK_URL}/api/config", status_code=500)
+        with pytest.raises(HTTPError):
+            provider.close()
+
+        # but only logged when finalized by garbage collection
+        provider = PiholeProvider(
+            'test', MOCK_URL, 'password', batch_apply=True
+        )
+        provider.apply(
+            plan_zone(provider, 'unit.tests.', 'batched', '10.0.0.7')
+        )
+        provider._finalizer()
+        assert 'DELETE' == mock_request.last_request.method
+
+        # at exit every open provider is closed, the first failing to send
+        # doesn't stop the others from doing so and once all have been, and
+        # output flushed, the process exits with 1
+        second = 'http://pi-hole-2.mock'
+        mock_request.post(
+            f"{second}/api/auth",
+            json={"session": {"sid": "second", "validity": 1800}},
+        )
+        mock_request.get(
+            f"{second}/api/config/dns",
+            json={"config": {"dns": {"hosts": [], "cnameRecords": []}}},
+        )
+        mock_request.patch(f"{second}/api/config", status_code=500)
+        mock_request.delete(f"{second}/api/auth", status_code=204)
+        mock_request.patch(f"{MOCK_URL}/api/config", json={})
+        with patch.object(PiholeProvider, '_open', WeakSet()):
+            failing = PiholeProvider(
+                'failing', second, 'password', batch_apply=True
+            )
+            failing.apply(
+                plan_zone(failing, 'unit.tests.', 'batched', '10.0.0.8')
+            )
+            provider = PiholeProvider(
+                'test', MOCK_URL, 'password', batch_apply=True
+            )
+            provider.apply(
+                plan_zone(provider, 'unit.tests.', 'batched', '10.0.0.9')
+            )
+            closed = PiholeProvider('closed', MOCK_URL, 'password')
+            closed.close()
+            assert {failing, provider} == set(PiholeProvider._open)
+
+            with patch('octodns_pihole._exit') as _exit, patch(
+                'octodns_pihole.logging.shutdown'
+            ), patch('octodns_pihole.sys') as _sys:
+                _sys.stderr = None
+                PiholeProvider._at_exit()
+            _exit.assert_called_once_with(1)
+            _sys.stdout.flush.assert_called_once()
+            assert any(
+                '10.0.0.9 batched.unit.tests.' in p['hosts'] for p in patches()
+            )
+            assert not PiholeProvider._open
+
+            # nothing failing, nothing to exit for
+            provider = PiholeProvider(
+                'test', MOCK_URL, 'password', batch_apply=True
+            )
+            provider.apply(
+                plan_zone(provider, 'unit.tests.', 'batched', '10.0.0.10')
+            )
+            with patch('octodns_pihole._exit') as _exit:
+                PiholeProvider._at_exit()
+            _exit.assert_not_called()
+            assert any(
+                '10.0.0.10 batched.unit.tests.' in p['hosts'] for p in patches()
+            )
+
+    def test_apply_zones(self, stub_pihole):
+        for kwargs in ({'merge': True}, {'update_mode': 'items'}):
+            stub_pihole.dns = {'hosts': [], 'cnameRecords': []}
+            provider = PiholeProvider(
+                'test', stub_pihole.url, 'password', **kwargs
+            )
+            plans = [
+                plan_zone(provider, 'unit.tests.', 'www', '10.0.0.1'),
+                plan_zone(provider, 'other.tld.', 'www', '10.0.0.2'),
+            ]
+            # another writer between planning and applying
+            stub_pihole.dns['hosts'].append('10.0.0.9 elsewhere.tld.')
+            stub_pihole.log.clear()
+            for plan in plans:
+                provider.apply(plan)
+
+            # every zone's apply starts from what Pi-hole then holds, the
+            # second's doesn't overwrite it with the first's stale copy
+            assert [
+                '10.0.0.9 elsewhere.tld.',
+                '10.0.0.1 www.unit.tests.',
+                '10.0.0.2 www.other.tld.',
+            ] == stub_pihole.dns['hosts']
+            if 'update_mode' in kwargs:
+                assert ('PATCH', '/api/config') not in stub_pihole.log
+            provider.close()
+
+    def test_fleet(self, mock_request):
+        replicas = ['http://pi-hole-2.mock', 'http://pi-hole-3.mock']
+        for url in replicas:
+            mock_request.post(
+                f"{url}/api/auth",
+                json={"session": {"sid": "replica", "validity": 1800}},
+            )
+            mock_request.patch(f"{url}/api/config", json={})
+            mock_request.delete(f"{url}/api/auth", status_code=204)
+        with open('tests/fixtures/dns.json') as fh:
+            mock_request.get(f"{MOCK_URL}/api/config/dns", json=json.load(fh))
+        mock_request.patch(f"{MOCK_URL}/api/config", json={})
+
+        def patched(url):
+            return [
+                sent_json(r.body)
+                for r in mock_request.request_history
+                if r.method == 'PATCH' and r.url.startswith(url)
+            ]
+
+        provider = PiholeProvider(
+            'test', [MOCK_URL] + replicas, 'password', timeout=5
+        )
+        assert isinstance(provider._client, PiholeFleet)
+        assert (5, 5) == provider._client.clients[2].timeout
+
+        provider.apply(plan_zone(provider, 'unit.tests.', 'fleet', '10.0.0.1'))
+
+        # populated from the primary only
+        gets = [r for r in mock_request.request_history if r.method == 'GET']
+        assert all(r.url.startswith(MOCK_URL) for r in gets)
+
+        # every member received the same update
+        sent = patched(MOCK_URL)
+        assert 1 == len(sent)
+        assert sent == patched(replicas[0]) == patched(replicas[1])
+        assert [MOCK_URL] + replicas == [
+            r.url for r in provider._client.results
+        ]
+        assert not any(r.error for r in provider._client.results)
+
+        # a replica failing fails the apply with the default policy
+        mock_request.patch(f"{replicas[1]}/api/config", status_code=500)
+        with pytest.raises(PiholeFleetException) as ctx:
+            provider.apply(
+                plan_zone(provider, 'unit.tests.', 'fleet', '10.0.0.2')
+            )
+        assert replicas[1] in str(ctx.value)
+        assert [None, None] == [r.error for r in ctx.value.results[:2]]
+
+        # but is only logged with the primary policy
+        provider._client.policy = 'primary'
+        provider.apply(plan_zone(provider, 'unit.tests.', 'fleet', '10.0.0.3'))
+        assert provider._client.results[2].error
+
+        # the primary failing is not
+        mock_request.patch(f"{MOCK_URL}/api/config", status_code=500)
+        with pytest.raises(PiholeFleetException):
+            provider.apply(
+                plan_zone(provider, 'unit.tests.', 'fleet', '10.0.0.4')
+            )
+
+        # while any member succeeding is enough with the any policy
+        provider._client.policy = 'any'
+        provider.apply(plan_zone(provider, 'unit.tests.', 'fleet', '10.0.0.5'))
+        mock_request.patch(f"{replicas[0]}/api/config", status_code=500)
+        with pytest.raises(PiholeFleetException):
+            provider.apply(
+                plan_zone(provider, 'unit.tests.', 'fleet', '10.0.0.6')
+            )
+
+        # nothing to send, nothing sent
+        calls = mock_request.call_count
+        provider._client.apply()
+        assert calls == mock_request.call_count
+
+        # every member is logged out, failures are logged
+        mock_request.delete(f"{replicas[0]}/api/auth", status_code=500)
+        provider.close()
+        deletes = [
+            r.url for r in mock_request.request_history if r.method == 'DELETE'
+        ]
+        assert 3 == len(deletes)
+
+        with pytest.raises(PiholeClientException) as ctx:
+            PiholeFleet([], 'most')
+        assert 'Unknown fleet policy "most"' == str(ctx.value)